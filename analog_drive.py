@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Global Definitions
+DEADZONE = 20  # Stick values closer to the center than this are ignored
+EXPO = 0.5  # Response curve, 0 is linear, 1 is fully cubic
+MAX_SPEED = 255  # The maximum speed of the dc motors
+
+
+class AnalogDrive:
+    """ Differential mixing of an analog stick into left and right wheel speeds
+
+    The stick axes are in the -255..255 range RemoteControl reports.
+    The deadzone and response curve are applied through a lookup table
+    that is computed once, so mixing a stick position costs two table
+    lookups and a few additions.
+    """
+
+    def __init__(self, deadzone=DEADZONE, expo=EXPO, max_speed=MAX_SPEED):
+        """ Precompute the response curve
+
+        :param deadzone: Stick values up to this distance from the center give 0
+        :param expo: Blend between a linear (0) and a cubic (1) response,
+                     a cubic response gives finer control at low speeds
+        :param max_speed: The speed at full stick deflection
+        """
+        if not 0 <= deadzone < 255:
+            raise ValueError('deadzone should be between 0 and 254')
+        if not 0 <= expo <= 1:
+            raise ValueError('expo should be between 0 and 1')
+
+        self.deadzone = deadzone
+        self.expo = expo
+        self.max_speed = max_speed
+        self._curve = [self._response(value) for value in range(-255, 256)]
+        self._last = None
+
+    def _response(self, value):
+        """ Returns the shaped speed for a single axis value """
+        magnitude = abs(value)
+        if magnitude <= self.deadzone:
+            return 0
+        position = (magnitude - self.deadzone) / (255 - self.deadzone)
+        speed = round(((1 - self.expo) * position + self.expo * position ** 3) * self.max_speed)
+        return speed if value > 0 else -speed
+
+    def mix(self, x, y):
+        """ Returns the (left, right) speeds for a stick position
+
+        :param x: Stick X axis, -255 is left
+        :param y: Stick Y axis, -255 is up (forward)
+        """
+        throttle = self._curve[255 - y]
+        steering = self._curve[255 + x]
+        left = max(-self.max_speed, min(self.max_speed, throttle + steering))
+        right = max(-self.max_speed, min(self.max_speed, throttle - steering))
+        return left, right
+
+    def update(self, x, y):
+        """ Returns the new (left, right) speeds, or None if they didn't change
+
+        :param x: Stick X axis, -255 is left
+        :param y: Stick Y axis, -255 is up (forward)
+        """
+        speeds = self.mix(x, y)
+        if speeds == self._last:
+            return None
+        self._last = speeds
+        return speeds
+
+    def reset(self):
+        """ Forget the last speeds, so the next update always returns them """
+        self._last = None
@@ -1,41 +1,281 @@
 #!/usr/bin/env python3
 
 import asyncio
+import heapq
+import logger
+import os
 import subprocess
+import wave
+
+# Global Definitions
+AUDIO_DIR = 'static/audio'
+CACHE_DIR = '.cache'  # Decoded cues in audio_dir, reused while newer than the mp3
+MAX_VOICES = 2  # Sounds playing at the same time
+MAX_QUEUED = 8  # Sounds waiting for a voice, the lowest priority is dropped beyond this
+NICENESS = 10  # The player processes run below the control loop
+CHUNK_TIME = 0.02  # Seconds of sound per write to a player
+LEAD_TIME = 0.06  # Seconds of sound the player may have buffered, this bounds the preemption delay
+
+# Decode an mp3 into a WAV file: command + [wav file, mp3 file]
+DECODE_COMMAND = ['mpg321', '--quiet', '-w']
+# A player reading raw 16 bit little endian PCM from stdin, formatted
+# with the channels and rate of the cue
+PLAYER_COMMAND = ['aplay', '--quiet', '-t', 'raw', '-f', 'S16_LE', '-c', '{channels}', '-r', '{rate}', '-']
+
+
+log = logger.get('audio')
+
+
+def _niced(command):
+    return ['nice', '-n', str(NICENESS)] + command
+
+
+class Cue:
+    """ A decoded sound, ready to be written to a player """
+
+    def __init__(self, name, pcm, channels, rate):
+        """ Initialise the cue
+
+        :param name: Name of the cue, its file name without .mp3
+        :param pcm: The 16 bit samples
+        :param channels: The number of channels
+        :param rate: The sample rate
+        """
+        self.name = name
+        self.pcm = pcm
+        self.channels = channels
+        self.rate = rate
+        self.frame_size = 2 * channels
+        self.duration = len(pcm) / (self.frame_size * rate)
+
+    @classmethod
+    def from_wav(cls, name, path):
+        """ Load a cue from a 16 bit WAV file """
+        with wave.open(path, 'rb') as wav:
+            if wav.getsampwidth() != 2:
+                raise ValueError('{} is not 16 bit'.format(path))
+            return cls(name, wav.readframes(wav.getnframes()), wav.getnchannels(), wav.getframerate())
+
+
+class Voice:
+    """ A long running player process and the cue it is playing """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.process = None
+        self.format = None  # (channels, rate) the process was started with
+        self.cue = None
+        self.priority = None
+        self._task = None
+
+    @property
+    def busy(self):
+        """ True while a cue is playing """
+        return self._task is not None and not self._task.done()
+
+    async def _open(self, channels, rate):
+        """ Start a player process for this format, unless it runs already """
+        if self.process and self.process.returncode is None:
+            if self.format == (channels, rate):
+                return
+            # Called from the feed task, so only the player is closed
+            await self._close_player()
+        command = [part.format(channels=channels, rate=rate) for part in PLAYER_COMMAND]
+        self.process = await asyncio.create_subprocess_exec(*_niced(command),
+                                                            stdin=subprocess.PIPE,
+                                                            stdout=subprocess.DEVNULL,
+                                                            stderr=subprocess.DEVNULL)
+        self.format = (channels, rate)
+
+    def play(self, cue, priority, done):
+        """ Start playing a cue, stops the cue playing now
+
+        :param cue: The Cue to play
+        :param priority: The priority of the cue
+        :param done: function called with this voice when the cue ends
+        """
+        self.stop()
+        self.cue = cue
+        self.priority = priority
+        self._task = self.loop.create_task(self._feed(cue))
+        self._task.add_done_callback(lambda task: done(self))
+
+    def stop(self):
+        """ Stop feeding the current cue, what the player buffered still plays """
+        if self.busy:
+            self._task.cancel()
+
+    async def _feed(self, cue):
+        """ Write the cue to the player in real time
+
+        The player never has more than LEAD_TIME buffered, so a
+        preempted cue stops almost at once.
+        """
+        await self._open(cue.channels, cue.rate)
+        chunk_size = int(cue.rate * CHUNK_TIME) * cue.frame_size
+        started = self.loop.time()
+        written = 0
+        while written < len(cue.pcm):
+            try:
+                self.process.stdin.write(cue.pcm[written:written + chunk_size])
+                await self.process.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                # The player died, reap it so the next cue starts a new one
+                await self._close_player()
+                return
+            written += chunk_size
+            ahead = started + written / (cue.frame_size * cue.rate) - self.loop.time()
+            if ahead > LEAD_TIME:
+                await asyncio.sleep(ahead - LEAD_TIME)
+        # Wait for the sound to finish before the voice is free again
+        await asyncio.sleep(max(0, started + cue.duration - self.loop.time()))
+
+    async def close(self):
+        """ Stop the cue and the player process """
+        self.stop()
+        await self._close_player()
+
+    async def _close_player(self):
+        """ Stop the player process, the cue being fed is left alone """
+        if self.process and self.process.returncode is None:
+            self.process.stdin.close()
+            try:
+                await asyncio.wait_for(self.process.wait(), 1)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+        self.process = None
 
 
 class Audio:
-    """ This class is a asyncio wrapper around the pyaudio library """
+    """ Low latency sound cues
+
+    The mp3 files in AUDIO_DIR are decoded once into a cache of cues.
+    Cues are written as raw samples to MAX_VOICES long running player
+    processes, so starting one only costs a pipe write. A cue that
+    finds all voices busy preempts the lowest priority one playing
+    below its own priority, or waits in a priority queue.
+    """
 
-    def __init__(self):
-        """ Initialise pyaudio. Call before starting asyncio loop
+    def __init__(self, loop=None, audio_dir=AUDIO_DIR, max_voices=MAX_VOICES):
+        """ Initialise the player. Call start from the asyncio loop
 
         You might want to set the volume to 100% from the CLI:
         amixer cset numid=1 -- 100%
 
         Also set this to make sure the audio is routed to the jack in stereo
         amixer cset numid=3 1
+
+        :param loop: The asyncio loop
+        :param audio_dir: Directory with the mp3 files of the cues
+        :param max_voices: Sounds playing at the same time
         """
-        pass
+        self.loop = loop or asyncio.get_event_loop()
+        self.audio_dir = audio_dir
+        self.cues = {}
+        self.voices = [Voice(self.loop) for _ in range(max_voices)]
+        self._queue = []  # heap of (-priority, sequence, cue)
+        self._sequence = 0
 
-    async def play_audio(self, filename):
-        """ Plays an audio file in a subprocess
+    async def start(self):
+        """ Decode all cues in audio_dir
+
+        The cues are decoded at the same time, in the default executor
+        """
+        if not os.path.isdir(self.audio_dir):
+            return
+        names = [filename[:-4] for filename in sorted(os.listdir(self.audio_dir)) if filename.endswith('.mp3')]
+        results = await asyncio.gather(*(self.load(name) for name in names), return_exceptions=True)
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                log.warning('Could not load sound cue %s: %s', name, result)
+
+    async def load(self, name):
+        """ Decode a cue into the cache
+
+        :param name: The file name of the cue in audio_dir, without .mp3
+        :returns: the Cue
+        """
+        self.cues[name] = await self.loop.run_in_executor(None, self._decode, name)
+        return self.cues[name]
+
+    def _decode(self, name):
+        """ Returns the Cue of an mp3, decodes it unless the cache is up to date """
+        source = os.path.join(self.audio_dir, name + '.mp3')
+        cache_dir = os.path.join(self.audio_dir, CACHE_DIR)
+        decoded = os.path.join(cache_dir, name + '.wav')
+        if not os.path.exists(decoded) or os.path.getmtime(decoded) < os.path.getmtime(source):
+            os.makedirs(cache_dir, exist_ok=True)
+            if subprocess.call(_niced(DECODE_COMMAND + [decoded, source]),
+                               stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL):
+                raise RuntimeError('Could not decode {}'.format(source))
+        return Cue.from_wav(name, decoded)
+
+    def play(self, name, priority=0):
+        """ Play a cue
+
+        :param name: The cue, its file name in audio_dir without .mp3
+        :param priority: Higher priorities preempt and go first
+        :returns: True if the cue started, False if it was queued or dropped
+        """
+        cue = self.cues.get(name)
+        if cue is None:
+            # Not preloaded, decode it first
+            self.loop.create_task(self._load_and_play(name, priority))
+            return False
+
+        voice = next((voice for voice in self.voices if not voice.busy), None)
+        if voice is None:
+            voice = min(self.voices, key=lambda voice: voice.priority)
+            if voice.priority >= priority:
+                self._enqueue(cue, priority)
+                return False
+        voice.play(cue, priority, self._voice_done)
+        return True
+
+    async def _load_and_play(self, name, priority):
+        try:
+            await self.load(name)
+        except (OSError, RuntimeError) as error:
+            log.warning('Could not load sound cue %s: %s', name, error)
+            return
+        self.play(name, priority)
+
+    def _enqueue(self, cue, priority):
+        heapq.heappush(self._queue, (-priority, self._sequence, cue))
+        self._sequence += 1
+        if len(self._queue) > MAX_QUEUED:
+            self._queue.remove(max(self._queue))
+            heapq.heapify(self._queue)
+
+    def _voice_done(self, voice):
+        """ Start the next queued cue on a voice that became free """
+        if self._queue and not voice.busy:
+            priority, sequence, cue = heapq.heappop(self._queue)
+            voice.play(cue, -priority, self._voice_done)
+
+    async def play_audio(self, filename, priority=0):
+        """ Plays an audio file
 
         :param filename: the audio file to play
+        :param priority: Higher priorities preempt and go first
         """
-        
-        player = await asyncio.create_subprocess_exec(*["mpg321", filename],
-                                                      stdin=subprocess.DEVNULL,
-                                                      stdout=subprocess.DEVNULL,
-                                                      stderr=subprocess.DEVNULL)
-        # result = await player.wait()  # wait until subprocess finishes, this is blocking?!
+        self.play(os.path.splitext(os.path.basename(filename))[0], priority)
+
+    async def shutdown(self):
+        """ Stop all sounds and player processes """
+        self._queue.clear()
+        for voice in self.voices:
+            await voice.close()
 
-    def shutdown(self):
-        """ Shuts down pyaudio interface """
-        pass
 
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
-    audio = Audio()
-    loop.run_until_complete(audio.play_audio('static/audio/hello_son.mp3'))
+    audio = Audio(loop)
+    loop.run_until_complete(audio.start())
+    audio.play('hello_son')
+    loop.run_until_complete(asyncio.sleep(audio.cues['hello_son'].duration + 0.1))
+    loop.run_until_complete(audio.shutdown())
     loop.close()
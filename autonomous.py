@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+""" Autonomous driving
+
+A table driven state machine that reacts to the sonar crossing
+MIN_DISTANCE and to timed maneuvers completing, instead of checking
+the distance every control cycle.
+"""
+
+import random
+import logger
+from dc_motors import sides
+from telemetry import STATE_AUTONOMOUS
+
+# Global Definitions
+MIN_DISTANCE = 20  # Distance to start avoiding
+MAX_TURN_ATTEMPTS = 3  # The amount of tries to turn until going in reverse
+CRUISE_SPEED = 100
+TURN_SPEED = 255
+REVERSE_SPEED = 100
+TURN_TIME = 3  # Seconds to turn away from a new obstacle
+RETRY_TURN_TIME = 2  # Seconds to turn on when the obstacle is still there
+REVERSE_TIME = 3
+CLEARANCE_TIME = 0.1  # Seconds to keep turning after the obstacle cleared, for the width of the robot
+
+# States
+IDLE = 'idle'
+CRUISE = 'cruise'
+TURNING = 'turning'
+CLEARED = 'cleared'
+REVERSING = 'reversing'
+
+# Events
+OBSTACLE = 'obstacle'  # The distance fell below MIN_DISTANCE
+CLEAR = 'clear'  # The distance rose above MIN_DISTANCE plus the hysteresis
+DONE = 'done'  # The timed maneuver completed
+
+# (state, event): name of the method handling it, which returns the next state.
+# Events without an entry are ignored in that state
+TRANSITIONS = {
+    (CRUISE, OBSTACLE): '_turn_away',
+    (TURNING, CLEAR): '_clear',
+    (TURNING, DONE): '_turn_done',
+    (CLEARED, OBSTACLE): '_turn_again',
+    (CLEARED, DONE): '_cruise',
+    (REVERSING, CLEAR): '_turn_away',
+    (REVERSING, DONE): '_reverse_done',
+}
+
+
+log = logger.get('autonomous')
+
+
+class AutonomousDriving:
+    """ Avoid obstacles by turning, and reversing when turning doesn't help
+
+    cruise    drive forward until the sonar reports an obstacle
+    turning   turn away for TURN_TIME, turn on for RETRY_TURN_TIME when
+              the obstacle is still there, reverse after MAX_TURN_ATTEMPTS
+    cleared   the obstacle is gone, turn a little further and cruise
+    reversing back up for REVERSE_TIME or until the obstacle clears and
+              turn away
+    """
+
+    def __init__(self, dc_motors, sonar, rng=None, min_distance=MIN_DISTANCE):
+        """ Initialise the state machine, it starts out idle
+
+        :param dc_motors: The DcMotors to drive
+        :param sonar: The forward facing Sonar
+        :param rng: random.Random for the turn directions, Robot passes
+                    its seeded one so runs can be replayed
+        :param min_distance: Distance in cm to start avoiding
+        """
+        self.dc_motors = dc_motors
+        self.sonar = sonar
+        self.random = rng or random.Random()
+        self.state = IDLE
+        self.turn_attempts = 0
+        self.turn_direction = None
+
+        # Optional TelemetryRecorder for the state transitions
+        self.telemetry = None
+
+        # Optional mapping.Mapper and planner.Planner, turns follow a
+        # fresh plan or go to the side with the most room
+        self.mapper = None
+        self.planner = None
+
+        self.threshold = sonar.add_threshold(min_distance,
+                                             on_below=lambda distance: self.handle(OBSTACLE),
+                                             on_clear=lambda distance: self.handle(CLEAR))
+
+    def start(self):
+        """ Start driving """
+        self.turn_attempts = 0
+        if self.threshold.below:
+            self._set_state(CRUISE)
+            self.handle(OBSTACLE)
+        else:
+            self._set_state(self._cruise())
+
+    def stop(self):
+        """ Stop reacting to events, the motors are left to the caller """
+        self._set_state(IDLE)
+
+    def handle(self, event):
+        """ Run the transition for an event in the current state """
+        handler = TRANSITIONS.get((self.state, event))
+        if handler:
+            self._set_state(getattr(self, handler)())
+
+    def _set_state(self, state):
+        if state != self.state:
+            log.debug('%s -> %s, distance %s', self.state, state, self.sonar.distance)
+            if self.telemetry:
+                self.telemetry.record_state(STATE_AUTONOMOUS, state)
+        self.state = state
+
+    def _maneuver(self, action):
+        """ Send DONE when a timed motor action completes
+
+        :param action: The future returned by the DcMotors motion method
+        """
+        action.add_done_callback(self._maneuver_done)
+
+    def _maneuver_done(self, action):
+        # Ignore actions that were replaced by another motion, also
+        # when that happened after they completed
+        if action is self.dc_motors.action and not action.cancelled():
+            self.handle(DONE)
+
+    def _turn(self, duration):
+        """ Turn in turn_direction, returns TURNING """
+        if self.turn_direction == 'left':
+            self._maneuver(self.dc_motors.set_wheels(sides(-TURN_SPEED, TURN_SPEED), duration))
+        else:
+            self._maneuver(self.dc_motors.set_wheels(sides(TURN_SPEED, -TURN_SPEED), duration))
+        return TURNING
+
+    def _cruise(self):
+        self.turn_attempts = 0
+        self.dc_motors.set_wheels(sides(CRUISE_SPEED, CRUISE_SPEED))
+        return CRUISE
+
+    def _turn_away(self):
+        """ Turn to the side of the plan or the most room, or a random way """
+        self.turn_attempts += 1
+        plan = self.planner.fresh_plan() if self.planner else None
+        if plan:
+            self.turn_direction = plan.turn_direction
+        else:
+            self.turn_direction = self.mapper.free_direction() if self.mapper else None
+        if self.turn_direction is None:
+            self.turn_direction = self.random.choice(('left', 'right'))
+        log.info('Getting too close, turning %s for %s seconds!', self.turn_direction, TURN_TIME)
+        return self._turn(TURN_TIME)
+
+    def _turn_done(self):
+        """ The turn completed, the obstacle can have cleared without a CLEAR
+        event when it already was before the turn started """
+        if not self.threshold.below:
+            return self._cruise()
+        return self._turn_again()
+
+    def _reverse_done(self):
+        """ Backed up for REVERSE_TIME, cruise when that was enough """
+        if not self.threshold.below:
+            return self._cruise()
+        return self._turn_away()
+
+    def _turn_again(self):
+        """ The obstacle is still there, turn on or back up """
+        if self.turn_attempts >= MAX_TURN_ATTEMPTS:
+            log.info('Turning doesnt seem to work, lets go in reverse')
+            self.turn_attempts = 0
+            self._maneuver(self.dc_motors.set_wheels(sides(-REVERSE_SPEED, -REVERSE_SPEED), REVERSE_TIME))
+            return REVERSING
+
+        self.turn_attempts += 1
+        log.info("Turning %s wasn't enough. Lets do another %s sec", self.turn_direction, RETRY_TURN_TIME)
+        return self._turn(RETRY_TURN_TIME)
+
+    def _clear(self):
+        """ Turn a little further so the side of the robot clears the obstacle """
+        log.info('Ok, obstacle cleared, moving forward...')
+        self._turn(CLEARANCE_TIME)
+        return CLEARED
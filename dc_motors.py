@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 
+import asyncio
+import math
+from array import array
+import metrics
 from pymata_aio.constants import Constants
-import time
+from pymata_aio.private_constants import PrivateConstants
+from telemetry import MOTOR, MOTOR_DIGITAL, MOTOR_PWM, STATE_MOTORS
 
 # Global Definitions
 # Pin Definitions
@@ -26,251 +31,503 @@ MOTOR_FRONT_RIGHT_PIN1 = 41
 MOTOR_FRONT_RIGHT_PIN2 = 40
 MOTOR_FRONT_RIGHT_ENABLE_PIN = 45
 
+# The wheels in the order of a speed vector: (direction pin 1, direction pin 2, enable pin)
+WHEELS = ((MOTOR_FRONT_LEFT_PIN1, MOTOR_FRONT_LEFT_PIN2, MOTOR_FRONT_LEFT_ENABLE_PIN),
+          (MOTOR_REAR_LEFT_PIN1, MOTOR_REAR_LEFT_PIN2, MOTOR_REAR_LEFT_ENABLE_PIN),
+          (MOTOR_REAR_RIGHT_PIN1, MOTOR_REAR_RIGHT_PIN2, MOTOR_REAR_RIGHT_ENABLE_PIN),
+          (MOTOR_FRONT_RIGHT_PIN1, MOTOR_FRONT_RIGHT_PIN2, MOTOR_FRONT_RIGHT_ENABLE_PIN))
 
-class DcMotors:
-    """ Contol DC Motors """
+# Calibration per wheel in WHEELS order. The gain scales the speed to
+# the PWM duty, make it negative for a motor that is wired the other
+# way round. The trim is added to the duty of a turning wheel, to
+# overcome the friction it takes to get going
+WHEEL_GAINS = (1.0, 1.0, 1.0, 1.0)
+WHEEL_TRIMS = (0, 0, 0, 0)
 
-    def __init__(self, board):
-        """ Initialise DC Motor Shield pins """
-        self.board = board
-        self._action_time_duration = None
+# Skid-steer model of the robot, calibrate against the real thing
+CM_PER_SECOND_PER_PWM = 0.2  # Ground speed of a wheel per unit of PWM
+TRACK_WIDTH = 15  # Effective distance between the left and right wheels in cm, grows with wheel slip
 
-        self.state = "stopped"
+# Speed ramps
+RAMP_PROFILE = 'trapezoidal'
+RAMP_TICK = 0.02  # Seconds between two steps of a ramp
+ACCELERATION = 1000  # Maximum change in PWM value per second, 0 to 255 in about 0.25 s
 
-        self.board.set_pin_mode(MOTOR_FRONT_LEFT_PIN1, Constants.OUTPUT)
-        self.board.set_pin_mode(MOTOR_FRONT_LEFT_PIN2, Constants.OUTPUT)
-        self.board.set_pin_mode(MOTOR_FRONT_LEFT_ENABLE_PIN, Constants.PWM)
 
-        self.board.set_pin_mode(MOTOR_REAR_LEFT_PIN1, Constants.OUTPUT)
-        self.board.set_pin_mode(MOTOR_REAR_LEFT_PIN2, Constants.OUTPUT)
-        self.board.set_pin_mode(MOTOR_REAR_LEFT_ENABLE_PIN, Constants.PWM)
+def trapezoidal_profile(start, end, steps):
+    """ Returns the speeds of a constant acceleration ramp
 
-        self.board.set_pin_mode(MOTOR_REAR_RIGHT_PIN1, Constants.OUTPUT)
-        self.board.set_pin_mode(MOTOR_REAR_RIGHT_PIN2, Constants.OUTPUT)
-        self.board.set_pin_mode(MOTOR_REAR_RIGHT_ENABLE_PIN, Constants.PWM)
+    The speed changes linearly, which is the sloped side of a
+    trapezoidal velocity profile.
 
-        self.board.set_pin_mode(MOTOR_FRONT_RIGHT_PIN1, Constants.OUTPUT)
-        self.board.set_pin_mode(MOTOR_FRONT_RIGHT_PIN2, Constants.OUTPUT)
-        self.board.set_pin_mode(MOTOR_FRONT_RIGHT_ENABLE_PIN, Constants.PWM)
+    :param start: The speed before the ramp
+    :param end: The speed at the end of the ramp
+    :param steps: The number of ticks the ramp takes
+    """
+    return array('h', (round(start + (end - start) * step / steps) for step in range(1, steps + 1)))
+
+
+def s_curve_profile(start, end, steps):
+    """ Returns the speeds of a jerk limited ramp
+
+    The acceleration builds up and falls off smoothly (smoothstep),
+    its peak is 1.5 times that of a trapezoidal ramp of the same length.
+
+    :param start: The speed before the ramp
+    :param end: The speed at the end of the ramp
+    :param steps: The number of ticks the ramp takes
+    """
+    speeds = array('h')
+    for step in range(1, steps + 1):
+        position = step / steps
+        speeds.append(round(start + (end - start) * position * position * (3 - 2 * position)))
+    return speeds
+
+
+# profile name: (function, peak acceleration relative to a linear ramp)
+RAMP_PROFILES = {
+    'trapezoidal': (trapezoidal_profile, 1.0),
+    's_curve': (s_curve_profile, 1.5),
+}
+
+
+def sides(left, right):
+    """ Returns the wheel speeds in WHEELS order that drive each side at its own speed
+
+    :param left: Speed of the left wheels -255-255, negative is reverse
+    :param right: Speed of the right wheels -255-255, negative is reverse
+    """
+    return left, left, right, right
 
-    @property
-    def action_time_duration(self):
-        return self._action_time_duration
 
-    @action_time_duration.setter
-    def action_time_duration(self, duration):
-        """ Setter for action_time_duration
+def twist_to_wheels(linear, angular, cm_per_pwm=CM_PER_SECOND_PER_PWM, track_width=TRACK_WIDTH):
+    """ Returns the wheel speeds in WHEELS order for a twist, skid-steer kinematics
 
-        This variable depicts for how long the motion should
-        run. If a time is not None it will return the current
-        timestamp
+    Both sides are scaled down together when one would go beyond 255,
+    so the robot still drives the same curve, only slower.
+
+    :param linear: Forward speed in cm per second
+    :param angular: Rotation in radians per second, positive turns left
+    :param cm_per_pwm: Ground speed of a wheel per unit of PWM
+    :param track_width: Effective distance between the left and right wheels in cm
+    """
+    left = (linear - angular * track_width / 2) / cm_per_pwm
+    right = (linear + angular * track_width / 2) / cm_per_pwm
+    scale = min(1.0, 255 / max(abs(left), abs(right), 1e-9))
+    return sides(int(round(left * scale)), int(round(right * scale)))
+
+
+def motion_state(speeds):
+    """ Returns the state of a motion: stopped, forward, reverse, turning_left or turning_right
+
+    :param speeds: Speeds of the wheels in WHEELS order
+    """
+    if not any(speeds):
+        return 'stopped'
+    if min(speeds) >= 0:
+        return 'forward'
+    if max(speeds) <= 0:
+        return 'reverse'
+    # Spinning on the spot, towards the side that goes backward
+    if speeds[0] + speeds[1] < speeds[2] + speeds[3]:
+        return 'turning_left'
+    return 'turning_right'
+
+
+class DcMotors:
+    """ Contol DC Motors
+
+    The motion methods only record the requested pin values. The
+    actual Firmata writes are done by the output task (see run) so
+    the control logic never waits on the serial link.
+
+    All motion goes through set_wheels, with a signed speed per wheel,
+    or set_twist, with a forward speed and a rotation. The ramps work
+    on these speeds, the per wheel gains and trims are applied when the
+    pin values are computed.
+
+    Speed changes follow a ramp profile instead of jumping to the new
+    speed in one write. The ramp of every wheel is computed when the
+    motion method is called and played by the ramp task, one step
+    per RAMP_TICK. A new motion replaces the ramp in progress and
+    starts from the speeds the wheels have at that moment.
+
+    A motion with a duration returns a future that completes with the
+    motion state when the duration has passed, timed by loop.call_at.
+    The motors keep running until the next command, it is up to the
+    caller what happens next. When a new motion starts first the
+    future is cancelled.
+    """
+
+    def __init__(self, board, loop=None, ramp_profile=RAMP_PROFILE,
+                 acceleration=ACCELERATION, ramp_tick=RAMP_TICK,
+                 gains=WHEEL_GAINS, trims=WHEEL_TRIMS):
+        """ Initialise DC Motor Shield
+
+        :param board: The asyncio interface into arduino (PymataCore)
+        :param loop: The asyncio loop, its clock times the motor actions
+        :param ramp_profile: A key of RAMP_PROFILES, or None to change
+                             speeds in a single write
+        :param acceleration: Maximum change in PWM value per second
+        :param ramp_tick: Seconds between two steps of a ramp
+        :param gains: Gain per wheel in WHEELS order, see WHEEL_GAINS
+        :param trims: Trim per wheel in WHEELS order, see WHEEL_TRIMS
+        """
+        if ramp_profile is not None and ramp_profile not in RAMP_PROFILES:
+            raise ValueError('Unknown ramp profile {}, choose from {}'.format(
+                ramp_profile, ', '.join(sorted(RAMP_PROFILES))))
+
+        self.board = board
+        self.loop = loop or asyncio.get_event_loop()
+
+        # The timed action in progress, see _drive
+        self.action = None
+        self.action_end = None
+        self._action_timer = None
+
+        self.ramp_profile = ramp_profile
+        self.acceleration = acceleration
+        self.ramp_tick = ramp_tick
+        self.gains = tuple(gains)
+        self.trims = tuple(trims)
+
+        # Signed speeds of the wheels in WHEELS order: the last values
+        # requested from the output task and where the motion ends up
+        self.speeds = (0, 0, 0, 0)
+        self.target = (0, 0, 0, 0)
+
+        # The ramp being played, one array of speeds per wheel
+        self._ramp = None
+        self._ramp_step = 0
+        self._ramp_pending = asyncio.Event()
+
+        # Functions to call with the speeds whenever they change
+        self._listeners = []
+
+        # Optional TelemetryRecorder for the pin writes and states
+        self.telemetry = None
+
+        self._state = "stopped"
+
+        # Pin values requested since the last flush, pin: value
+        self._digital_pending = {}
+        self._analog_pending = {}
+        self._output_pending = asyncio.Event()
+
+        # Shadow register of the values last written to the board.
+        # Requests for a value a pin already has are not sent again.
+        self._digital_written = {}
+        self._analog_written = {}
+        self.writes_sent = 0
+        self.writes_suppressed = 0
+
+    async def start(self):
+        """ Configure the DC Motor Shield pins """
+        await self.board.set_pin_mode(MOTOR_FRONT_LEFT_PIN1, Constants.OUTPUT)
+        await self.board.set_pin_mode(MOTOR_FRONT_LEFT_PIN2, Constants.OUTPUT)
+        await self.board.set_pin_mode(MOTOR_FRONT_LEFT_ENABLE_PIN, Constants.PWM)
+
+        await self.board.set_pin_mode(MOTOR_REAR_LEFT_PIN1, Constants.OUTPUT)
+        await self.board.set_pin_mode(MOTOR_REAR_LEFT_PIN2, Constants.OUTPUT)
+        await self.board.set_pin_mode(MOTOR_REAR_LEFT_ENABLE_PIN, Constants.PWM)
+
+        await self.board.set_pin_mode(MOTOR_REAR_RIGHT_PIN1, Constants.OUTPUT)
+        await self.board.set_pin_mode(MOTOR_REAR_RIGHT_PIN2, Constants.OUTPUT)
+        await self.board.set_pin_mode(MOTOR_REAR_RIGHT_ENABLE_PIN, Constants.PWM)
+
+        await self.board.set_pin_mode(MOTOR_FRONT_RIGHT_PIN1, Constants.OUTPUT)
+        await self.board.set_pin_mode(MOTOR_FRONT_RIGHT_PIN2, Constants.OUTPUT)
+        await self.board.set_pin_mode(MOTOR_FRONT_RIGHT_ENABLE_PIN, Constants.PWM)
+
+    async def run(self):
+        """ Motor output and ramp tasks """
+        await asyncio.gather(self._write_output(), self._play_ramps())
+
+    async def _write_output(self):
+        """ Motor output task
+
+        Waits until a motion method requested new pin values and
+        writes them to the board.
         """
-        if duration:
-            self._action_time_duration = duration
+        while True:
+            await self._output_pending.wait()
+            self._output_pending.clear()
+            await self.flush()
+
+    async def flush(self):
+        """ Write all pending pin values to the board """
+        if metrics.ENABLED:
+            started = metrics.clock()
+            await self._flush()
+            metrics.FIRMATA_WRITE.observe_since(started)
         else:
-            self._action_time_duration = None
+            await self._flush()
+
+    async def _flush(self):
+        digital, self._digital_pending = self._digital_pending, {}
+        analog, self._analog_pending = self._analog_pending, {}
+
+        # Direction pins first, one port message per port, followed
+        # by all PWM enable pins back to back
+        self._digital_written.update(digital)
+        ports = self._build_ports(digital)
+        for port, value in ports.items():
+            await self.board._send_command((PrivateConstants.DIGITAL_MESSAGE + port,
+                                            value & 0x7f, (value >> 7) & 0x7f))
+
+        for pin, value in analog.items():
+            await self.board.analog_write(pin, value)
+        self._analog_written.update(analog)
+
+        self.writes_sent += len(ports) + len(analog)
+
+        if self.telemetry:
+            for pin, value in digital.items():
+                self.telemetry.record(MOTOR, pin, value, MOTOR_DIGITAL)
+            for pin, value in analog.items():
+                self.telemetry.record(MOTOR, pin, value, MOTOR_PWM)
+
+    def _build_ports(self, digital):
+        """ Returns the state of every port with a pending digital value
+
+        A Firmata digital message always carries the state of all
+        eight pins of a port. The state is built from the shadow
+        register, so the motor pins own the output pins of their
+        ports: other output pins on them are sent as 0.
+
+        :param digital: The pending digital values, pin: value
+        :returns: dictionary port: value of its eight pins
+        """
+        ports = dict.fromkeys((pin // 8 for pin in digital), 0)
+        for pin, value in self._digital_written.items():
+            if value and pin // 8 in ports:
+                ports[pin // 8] |= 1 << (pin % 8)
+        return ports
 
+    def resync(self):
+        """ Write every known pin value again on the next flush
 
-    def forward(self, speed, duration=None):
-        """ Move forward
+        Use this when the shadow register can no longer be trusted,
+        for example after the Arduino has been reset.
+        """
+        for pin, value in self._digital_written.items():
+            self._digital_pending.setdefault(pin, value)
+        for pin, value in self._analog_written.items():
+            self._analog_pending.setdefault(pin, value)
+        self._digital_written.clear()
+        self._analog_written.clear()
+        self._output_pending.set()
+
+    def _digital_write(self, pin, value):
+        """ Queue a digital pin value for the output task
+
+        Nothing is queued when the pin already has this value
+        """
+        self._queue_write(pin, value, self._digital_pending, self._digital_written)
 
-        :param speed: Speed of motors 0-255
-        :param duration: Duration of the action in seconds
+    def _analog_write(self, pin, value):
+        """ Queue a PWM pin value for the output task
+
+        Nothing is queued when the pin already has this value
         """
-        self.action_time_duration = duration
-        self.action_time_start = time.time()
-
-        self.state = 'forward'
-        self.board.digital_write(MOTOR_FRONT_LEFT_PIN1, 0)
-        self.board.digital_write(MOTOR_FRONT_LEFT_PIN2, 1)
-        self.board.digital_write(MOTOR_REAR_LEFT_PIN1, 0)
-        self.board.digital_write(MOTOR_REAR_LEFT_PIN2, 1)
-        self.board.digital_write(MOTOR_REAR_RIGHT_PIN1, 0)
-        self.board.digital_write(MOTOR_REAR_RIGHT_PIN2, 1)
-        self.board.digital_write(MOTOR_FRONT_RIGHT_PIN1, 0)
-        self.board.digital_write(MOTOR_FRONT_RIGHT_PIN2, 1)
-
-        self.board.analog_write(MOTOR_FRONT_LEFT_ENABLE_PIN, speed)
-        self.board.analog_write(MOTOR_REAR_LEFT_ENABLE_PIN, speed)
-        self.board.analog_write(MOTOR_REAR_RIGHT_ENABLE_PIN, speed)
-        self.board.analog_write(MOTOR_FRONT_RIGHT_ENABLE_PIN, speed)
-
-    def up_left(self, speed, duration=None):
-        """ Move soft left forward
-
-        :param speed: Speed of motors 0-255
-        :param duration: Duration of the action in seconds
+        self._queue_write(pin, value, self._analog_pending, self._analog_written)
+
+    def _queue_write(self, pin, value, pending, written):
+        """ Queue a pin value unless the shadow register already has it
+
+        :param pin: The pin to write
+        :param value: The value to write
+        :param pending: The pending values for this type of pin
+        :param written: The shadow register for this type of pin
         """
-        self.action_time_duration = duration
-        self.action_time_start = time.time()
-
-        self.state = 'forward'
-        self.board.digital_write(MOTOR_FRONT_LEFT_PIN1, 0)
-        self.board.digital_write(MOTOR_FRONT_LEFT_PIN2, 1)
-        self.board.digital_write(MOTOR_REAR_LEFT_PIN1, 0)
-        self.board.digital_write(MOTOR_REAR_LEFT_PIN2, 1)
-        self.board.digital_write(MOTOR_REAR_RIGHT_PIN1, 0)
-        self.board.digital_write(MOTOR_REAR_RIGHT_PIN2, 1)
-        self.board.digital_write(MOTOR_FRONT_RIGHT_PIN1, 0)
-        self.board.digital_write(MOTOR_FRONT_RIGHT_PIN2, 1)
-
-        self.board.analog_write(MOTOR_FRONT_LEFT_ENABLE_PIN, int(speed/4))
-        self.board.analog_write(MOTOR_REAR_LEFT_ENABLE_PIN, int(speed/4))
-        self.board.analog_write(MOTOR_REAR_RIGHT_ENABLE_PIN, speed)
-        self.board.analog_write(MOTOR_FRONT_RIGHT_ENABLE_PIN, speed)
-
-    def up_right(self, speed, duration=None):
-        """ Move soft right forward
-
-        :param speed: Speed of motors 0-255
-        :param duration: Duration of the action in seconds
+        if written.get(pin) == value:
+            # Drop an earlier request that has not been flushed yet
+            pending.pop(pin, None)
+            self.writes_suppressed += 1
+        else:
+            pending[pin] = value
+            self._output_pending.set()
+
+    def _set_target(self, speeds, ramp=True):
+        """ Move the wheels to new speeds
+
+        :param speeds: Speeds of the wheels -255-255 in WHEELS order, negative is reverse
+        :param ramp: Follow the ramp profile, False writes the speeds at once
         """
-        self.action_time_duration = duration
-        self.action_time_start = time.time()
-
-        self.state = 'forward'
-        self.board.digital_write(MOTOR_FRONT_LEFT_PIN1, 0)
-        self.board.digital_write(MOTOR_FRONT_LEFT_PIN2, 1)
-        self.board.digital_write(MOTOR_REAR_LEFT_PIN1, 0)
-        self.board.digital_write(MOTOR_REAR_LEFT_PIN2, 1)
-        self.board.digital_write(MOTOR_REAR_RIGHT_PIN1, 0)
-        self.board.digital_write(MOTOR_REAR_RIGHT_PIN2, 1)
-        self.board.digital_write(MOTOR_FRONT_RIGHT_PIN1, 0)
-        self.board.digital_write(MOTOR_FRONT_RIGHT_PIN2, 1)
-
-        self.board.analog_write(MOTOR_FRONT_LEFT_ENABLE_PIN, speed)
-        self.board.analog_write(MOTOR_REAR_LEFT_ENABLE_PIN, speed)
-        self.board.analog_write(MOTOR_REAR_RIGHT_ENABLE_PIN, int(speed/4))
-        self.board.analog_write(MOTOR_FRONT_RIGHT_ENABLE_PIN, int(speed/4))
-
-    def down_left(self, speed, duration=None):
-        """ Move soft left reverse
-
-        :param speed: Speed of motors 0-255
-        :param duration: Duration of the action in seconds
+        self.target = tuple(speeds)
+        if not ramp or self.ramp_profile is None:
+            self._ramp = None
+            self._write_speeds(self.target)
+            return
+
+        self._ramp = self._plan_ramp(self.speeds, self.target)
+        self._ramp_step = 0
+        if self._ramp:
+            self._ramp_pending.set()
+
+    def _plan_ramp(self, start, end):
+        """ Compute the ramp of every wheel
+
+        All wheels take the same number of steps, so they reach their
+        speeds together and the motion keeps its shape while ramping.
+
+        :param start: Speeds of the wheels at the start of the ramp
+        :param end: Speeds of the wheels at the end of the ramp
+        :returns: list of arrays of speeds, one per wheel, or None if
+                  there is nothing to change
         """
-        self.action_time_duration = duration
-        self.action_time_start = time.time()
-
-        self.state = 'reverse'
-        self.board.digital_write(MOTOR_FRONT_LEFT_PIN1, 1)
-        self.board.digital_write(MOTOR_FRONT_LEFT_PIN2, 0)
-        self.board.digital_write(MOTOR_REAR_LEFT_PIN1, 1)
-        self.board.digital_write(MOTOR_REAR_LEFT_PIN2, 0)
-        self.board.digital_write(MOTOR_REAR_RIGHT_PIN1, 1)
-        self.board.digital_write(MOTOR_REAR_RIGHT_PIN2, 0)
-        self.board.digital_write(MOTOR_FRONT_RIGHT_PIN1, 1)
-        self.board.digital_write(MOTOR_FRONT_RIGHT_PIN2, 0)
-
-        self.board.analog_write(MOTOR_FRONT_LEFT_ENABLE_PIN, int(speed/4))
-        self.board.analog_write(MOTOR_REAR_LEFT_ENABLE_PIN, int(speed/4))
-        self.board.analog_write(MOTOR_REAR_RIGHT_ENABLE_PIN, speed)
-        self.board.analog_write(MOTOR_FRONT_RIGHT_ENABLE_PIN, speed)
-
-    def down_right(self, speed, duration=None):
-        """ Move soft right reverse
-
-        :param speed: Speed of motors 0-255
-        :param duration: Duration of the action in seconds
+        change = max(abs(to - frm) for frm, to in zip(start, end))
+        if not change:
+            return None
+        profile, peak = RAMP_PROFILES[self.ramp_profile]
+        steps = max(1, math.ceil(change * peak / (self.acceleration * self.ramp_tick)))
+        return [profile(frm, to, steps) for frm, to in zip(start, end)]
+
+    async def _play_ramps(self):
+        """ Ramp task
+
+        Writes the next step of the current ramp every ramp_tick
+        until it is done. The ramp can be replaced at any point.
         """
-        self.action_time_duration = duration
-        self.action_time_start = time.time()
-
-        self.state = 'reverse'
-        self.board.digital_write(MOTOR_FRONT_LEFT_PIN1, 1)
-        self.board.digital_write(MOTOR_FRONT_LEFT_PIN2, 0)
-        self.board.digital_write(MOTOR_REAR_LEFT_PIN1, 1)
-        self.board.digital_write(MOTOR_REAR_LEFT_PIN2, 0)
-        self.board.digital_write(MOTOR_REAR_RIGHT_PIN1, 1)
-        self.board.digital_write(MOTOR_REAR_RIGHT_PIN2, 0)
-        self.board.digital_write(MOTOR_FRONT_RIGHT_PIN1, 1)
-        self.board.digital_write(MOTOR_FRONT_RIGHT_PIN2, 0)
-
-        self.board.analog_write(MOTOR_FRONT_LEFT_ENABLE_PIN, speed)
-        self.board.analog_write(MOTOR_REAR_LEFT_ENABLE_PIN, speed)
-        self.board.analog_write(MOTOR_REAR_RIGHT_ENABLE_PIN, int(speed/4))
-        self.board.analog_write(MOTOR_FRONT_RIGHT_ENABLE_PIN, int(speed/4))
-
-    def reverse(self, speed, duration=None):
-        """ Reverse motors
-
-        :param speed: Speed of motors 0-255
-        :param duration: Duration of the action in seconds
+        while True:
+            await self._ramp_pending.wait()
+            self._ramp_pending.clear()
+
+            deadline = self.loop.time()
+            while self._ramp:
+                step = self._ramp_step
+                self._write_speeds([speeds[step] for speeds in self._ramp])
+                self._ramp_step = step + 1
+                if self._ramp_step >= len(self._ramp[0]):
+                    self._ramp = None
+                    break
+
+                deadline += self.ramp_tick
+                await asyncio.sleep(deadline - self.loop.time())
+
+    def duties(self, speeds):
+        """ Returns the signed PWM duties of wheel speeds, calibrated with the gains and trims
+
+        :param speeds: Speeds of the wheels -255-255 in WHEELS order
         """
-        self.action_time_duration = duration
-        self.action_time_start = time.time()
-
-        self.state = 'reverse'
-        self.board.digital_write(MOTOR_FRONT_LEFT_PIN1, 1)
-        self.board.digital_write(MOTOR_FRONT_LEFT_PIN2, 0)
-        self.board.digital_write(MOTOR_REAR_LEFT_PIN1, 1)
-        self.board.digital_write(MOTOR_REAR_LEFT_PIN2, 0)
-        self.board.digital_write(MOTOR_REAR_RIGHT_PIN1, 1)
-        self.board.digital_write(MOTOR_REAR_RIGHT_PIN2, 0)
-        self.board.digital_write(MOTOR_FRONT_RIGHT_PIN1, 1)
-        self.board.digital_write(MOTOR_FRONT_RIGHT_PIN2, 0)
-
-        self.board.analog_write(MOTOR_FRONT_LEFT_ENABLE_PIN, speed)
-        self.board.analog_write(MOTOR_REAR_LEFT_ENABLE_PIN, speed)
-        self.board.analog_write(MOTOR_REAR_RIGHT_ENABLE_PIN, speed)
-        self.board.analog_write(MOTOR_FRONT_RIGHT_ENABLE_PIN, speed)
-
-    def right(self, speed, duration=None):
-        """ Turns right
-
-        :param speed: speed of motors between 0-255
-        :param duration: Duration of the action in seconds
+        duties = []
+        for speed, gain, trim in zip(speeds, self.gains, self.trims):
+            duty = speed * gain
+            if duty > 0:
+                duty = min(255, round(duty + trim))
+            elif duty < 0:
+                duty = max(-255, round(duty - trim))
+            duties.append(int(duty))
+        return duties
+
+    def _write_speeds(self, speeds):
+        """ Queue the pin values for signed wheel speeds
+
+        The direction bits and PWM duty of all wheels are computed in
+        one go, the output task sends them in a single flush.
+
+        :param speeds: Speeds of the wheels -255-255 in WHEELS order
         """
+        for (pin1, pin2, enable_pin), duty in zip(WHEELS, self.duties(speeds)):
+            # The direction pins are left alone while a wheel is idle
+            if duty > 0:
+                self._digital_write(pin1, 0)
+                self._digital_write(pin2, 1)
+            elif duty < 0:
+                self._digital_write(pin1, 1)
+                self._digital_write(pin2, 0)
+            self._analog_write(enable_pin, abs(duty))
+
+        speeds = tuple(speeds)
+        if speeds != self.speeds:
+            self.speeds = speeds
+            for listener in self._listeners:
+                listener(speeds)
+
+    def add_listener(self, listener):
+        """ Call listener(speeds) whenever the wheel speeds change
+
+        :param listener: function taking the signed speeds in WHEELS order
+        """
+        self._listeners.append(listener)
 
-        self.action_time_duration = duration
-        self.action_time_start = time.time()
-        self.state = 'turning_left'
-
-        self.board.digital_write(MOTOR_FRONT_LEFT_PIN1, 0)
-        self.board.digital_write(MOTOR_FRONT_LEFT_PIN2, 1)
-        self.board.digital_write(MOTOR_REAR_LEFT_PIN1, 0)
-        self.board.digital_write(MOTOR_REAR_LEFT_PIN2, 1)
-        self.board.digital_write(MOTOR_REAR_RIGHT_PIN1, 1)
-        self.board.digital_write(MOTOR_REAR_RIGHT_PIN2, 0)
-        self.board.digital_write(MOTOR_FRONT_RIGHT_PIN1, 1)
-        self.board.digital_write(MOTOR_FRONT_RIGHT_PIN2, 0)
+    @property
+    def state(self):
+        """ The current motion: stopped, forward, reverse, turning_left or turning_right """
+        return self._state
 
-        self.board.analog_write(MOTOR_FRONT_LEFT_ENABLE_PIN, speed)
-        self.board.analog_write(MOTOR_REAR_LEFT_ENABLE_PIN, speed)
-        self.board.analog_write(MOTOR_REAR_RIGHT_ENABLE_PIN, speed)
-        self.board.analog_write(MOTOR_FRONT_RIGHT_ENABLE_PIN, speed)
+    @state.setter
+    def state(self, state):
+        if state != self._state and self.telemetry:
+            self.telemetry.record_state(STATE_MOTORS, state)
+        self._state = state
 
-    def left(self, speed, duration=None):
-        """ Turn left
+    def _drive(self, state, speeds, duration=None):
+        """ Start a motion
 
-        :param speed: speed of motors between 0-255
+        :param state: The state of the motion
+        :param speeds: Speeds of the wheels -255-255 in WHEELS order, negative is reverse
         :param duration: Duration of the action in seconds
+        :returns: Future of the action when there is a duration, else None
         """
+        self._cancel_action()
+        self.state = state
+        self._set_target(speeds)
+
+        if not duration:
+            return None
+        self.action = self.loop.create_future()
+        self.action_end = self.loop.time() + duration
+        self._action_timer = self.loop.call_at(self.action_end, self._finish_action, self.action, state)
+        return self.action
+
+    def _finish_action(self, action, state):
+        """ Complete a timed action, called by the loop at action_end """
+        self._action_timer = None
+        self.action_end = None
+        if not action.done():
+            action.set_result(state)
+
+    def _cancel_action(self):
+        """ Cancel the timed action in progress, if any """
+        if self._action_timer:
+            self._action_timer.cancel()
+            self._action_timer = None
+        if self.action and not self.action.done():
+            self.action.cancel()
+        self.action = None
+        self.action_end = None
+
+    def set_wheels(self, speeds, duration=None):
+        """ Drive every wheel at its own speed
+
+        :param speeds: Speeds of the wheels -255-255 in WHEELS order, negative
+                       is reverse. See sides for the common case
+        :param duration: Duration of the action in seconds
+        :returns: Future of the action when there is a duration, else None
+        """
+        speeds = tuple(max(-255, min(255, int(speed))) for speed in speeds)
+        if len(speeds) != len(WHEELS):
+            raise ValueError('Expected {} wheel speeds, got {}'.format(len(WHEELS), len(speeds)))
+        return self._drive(motion_state(speeds), speeds, duration)
 
-        self.action_time_duration = duration
-        self.action_time_start = time.time()
-        self.state = 'turning_right'
+    def set_twist(self, linear, angular, duration=None):
+        """ Drive with a forward speed and a rotation, see twist_to_wheels
 
-        self.board.digital_write(MOTOR_FRONT_LEFT_PIN1, 1)
-        self.board.digital_write(MOTOR_FRONT_LEFT_PIN2, 0)
-        self.board.digital_write(MOTOR_REAR_LEFT_PIN1, 1)
-        self.board.digital_write(MOTOR_REAR_LEFT_PIN2, 0)
-        self.board.digital_write(MOTOR_REAR_RIGHT_PIN1, 0)
-        self.board.digital_write(MOTOR_REAR_RIGHT_PIN2, 1)
-        self.board.digital_write(MOTOR_FRONT_RIGHT_PIN1, 0)
-        self.board.digital_write(MOTOR_FRONT_RIGHT_PIN2, 1)
+        :param linear: Forward speed in cm per second
+        :param angular: Rotation in radians per second, positive turns left
+        :param duration: Duration of the action in seconds
+        :returns: Future of the action when there is a duration, else None
+        """
+        return self.set_wheels(twist_to_wheels(linear, angular), duration)
 
-        self.board.analog_write(MOTOR_FRONT_LEFT_ENABLE_PIN, speed)
-        self.board.analog_write(MOTOR_REAR_LEFT_ENABLE_PIN, speed)
-        self.board.analog_write(MOTOR_REAR_RIGHT_ENABLE_PIN, speed)
-        self.board.analog_write(MOTOR_FRONT_RIGHT_ENABLE_PIN, speed)
+    def stop(self, ramp=True):
+        """ Stop all motors
 
-    def stop(self):
-        """ Stop all motors """
+        :param ramp: Slow down along the ramp profile, False cuts the
+                     power at once
+        """
 
+        self._cancel_action()
         self.state = 'stopped'
-
-        self.board.analog_write(MOTOR_FRONT_LEFT_ENABLE_PIN, 0)
-        self.board.analog_write(MOTOR_REAR_LEFT_ENABLE_PIN, 0)
-        self.board.analog_write(MOTOR_REAR_RIGHT_ENABLE_PIN, 0)
-        self.board.analog_write(MOTOR_FRONT_RIGHT_ENABLE_PIN, 0)
+        self._set_target((0, 0, 0, 0), ramp)
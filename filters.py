@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+from bisect import bisect_left, insort
+
+# Global Definitions
+DEFAULT_WINDOW_SIZE = 3
+
+
+class MovingAverageFilter:
+    """ Moving average over the last window_size samples
+
+    Keeps a running sum so every update is a subtraction and an addition
+    """
+
+    def __init__(self, window_size=DEFAULT_WINDOW_SIZE, initial=0):
+        """ Initialise the filter
+
+        :param window_size: the number of samples to average
+        :param initial: the value the buffer is filled with
+        """
+        self.window_size = window_size
+        self.reset(initial)
+
+    def reset(self, initial=0):
+        """ Fill the buffer with the initial value """
+        self._buffer = [initial] * self.window_size
+        self._index = 0
+        self._sum = initial * self.window_size
+        self.value = initial
+
+    def update(self, sample):
+        """ Add a sample and return the filtered value """
+        self._sum += sample - self._buffer[self._index]
+        self._buffer[self._index] = sample
+        self._index = (self._index + 1) % self.window_size
+        self.value = self._sum / self.window_size
+        return self.value
+
+
+class MedianFilter:
+    """ Median of the last window_size samples
+
+    Rejects single spikes such as missed echoes. Next to the ring buffer
+    a sorted copy of the window is kept up to date. An update is a
+    binary search plus a shift of at most window_size elements, so it
+    is O(window_size) rather than O(1). For the few samples a sonar
+    window holds that shift is a single memmove, cheaper than keeping
+    two heaps balanced.
+    """
+
+    def __init__(self, window_size=DEFAULT_WINDOW_SIZE, initial=0):
+        """ Initialise the filter
+
+        :param window_size: the number of samples to take the median of
+        :param initial: the value the buffer is filled with
+        """
+        self.window_size = window_size
+        self.reset(initial)
+
+    def reset(self, initial=0):
+        """ Fill the buffer with the initial value """
+        self._buffer = [initial] * self.window_size
+        self._sorted = [initial] * self.window_size
+        self._index = 0
+        self.value = initial
+
+    def update(self, sample):
+        """ Add a sample and return the filtered value """
+        del self._sorted[bisect_left(self._sorted, self._buffer[self._index])]
+        insort(self._sorted, sample)
+        self._buffer[self._index] = sample
+        self._index = (self._index + 1) % self.window_size
+
+        middle = self.window_size // 2
+        if self.window_size % 2:
+            self.value = self._sorted[middle]
+        else:
+            self.value = (self._sorted[middle - 1] + self._sorted[middle]) / 2
+        return self.value
+
+
+class ExponentialMovingAverageFilter:
+    """ Exponential moving average
+
+    The smoothing factor is derived from the window size the same way
+    as for an N-day EMA: alpha = 2 / (window_size + 1)
+    """
+
+    def __init__(self, window_size=DEFAULT_WINDOW_SIZE, initial=0, alpha=None):
+        """ Initialise the filter
+
+        :param window_size: the number of samples the filter roughly spans
+        :param initial: the starting value
+        :param alpha: the smoothing factor, overrides window_size
+        """
+        self.window_size = window_size
+        self.alpha = alpha if alpha is not None else 2 / (window_size + 1)
+        self.reset(initial)
+
+    def reset(self, initial=0):
+        """ Restart the filter at the initial value """
+        self.value = initial
+
+    def update(self, sample):
+        """ Add a sample and return the filtered value """
+        self.value += self.alpha * (sample - self.value)
+        return self.value
+
+
+class KalmanFilter:
+    """ One dimensional Kalman filter for a slowly changing distance
+
+    The distance is modelled as constant with some process noise, the
+    sonar readings as the distance plus measurement noise.
+    """
+
+    def __init__(self, window_size=DEFAULT_WINDOW_SIZE, initial=0,
+                 process_variance=1.0, measurement_variance=4.0):
+        """ Initialise the filter
+
+        :param window_size: not used, accepted so all filters can be
+                            created the same way
+        :param initial: the starting estimate
+        :param process_variance: how much the distance changes between samples (cm^2)
+        :param measurement_variance: the noise of a single reading (cm^2)
+        """
+        self.window_size = window_size
+        self.process_variance = process_variance
+        self.measurement_variance = measurement_variance
+        self.reset(initial)
+
+    def reset(self, initial=0):
+        """ Restart the filter at the initial value """
+        self.value = initial
+        self.error_variance = self.measurement_variance
+
+    def update(self, sample):
+        """ Add a sample and return the filtered value """
+        self.error_variance += self.process_variance
+        gain = self.error_variance / (self.error_variance + self.measurement_variance)
+        self.value += gain * (sample - self.value)
+        self.error_variance *= 1 - gain
+        return self.value
+
+
+FILTERS = {
+    'moving_average': MovingAverageFilter,
+    'median': MedianFilter,
+    'ema': ExponentialMovingAverageFilter,
+    'kalman': KalmanFilter,
+}
+
+
+def create_filter(filter_type='moving_average', window_size=DEFAULT_WINDOW_SIZE, initial=0):
+    """ Create a streaming filter by name
+
+    :param filter_type: one of the keys in FILTERS
+    :param window_size: the number of samples the filter works on
+    :param initial: the value the filter starts with
+    """
+    try:
+        filter_class = FILTERS[filter_type]
+    except KeyError:
+        raise ValueError('Unknown filter type {}, choose from {}'
+                         .format(filter_type, ', '.join(sorted(FILTERS))))
+    return filter_class(window_size, initial)
+
+
+if __name__ == '__main__':
+    # Micro-benchmark of the cost per sample, compared against
+    # the deque and numpy based moving average Sonar used before
+    import random
+    import timeit
+    from collections import deque
+    from utils import moving_average
+
+    samples = [random.randint(5, 200) for _ in range(1000)]
+    number = 100
+
+    def run_moving_average():
+        data = deque([200, 200, 200], maxlen=3)
+        for sample in samples:
+            data.append(sample)
+            moving_average(list(data), 3)
+
+    def run_filter(streaming_filter):
+        update = streaming_filter.update
+        for sample in samples:
+            update(sample)
+
+    results = [('utils.moving_average', timeit.timeit(run_moving_average, number=number))]
+    for name in sorted(FILTERS):
+        streaming_filter = create_filter(name, DEFAULT_WINDOW_SIZE, 200)
+        results.append((name, timeit.timeit(lambda: run_filter(streaming_filter), number=number)))
+
+    for name, seconds in results:
+        print('{:<22} {:8.3f} us/sample'.format(name, seconds / (number * len(samples)) * 1e6))
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+""" Logging that keeps the console off the control loop
+
+Every subsystem logs through a standard logging.Logger below the
+ROOT logger. Its records are put on a bounded queue by a
+QueueHandler, a QueueListener thread samples, rate limits, formats
+and writes them, so a slow console or SSH session never blocks the
+loop:
+
+    log = logger.get('autonomous')
+    log.debug('Distance: %s', distance)
+
+Records logged before start are written once the listener runs. The
+message is only formatted with its args in the listener thread, pass
+values that don't change afterwards.
+"""
+
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+# Global Definitions
+ROOT = 'timmy'  # Name of the logger all subsystem loggers are below
+DEFAULT_LEVEL = logging.INFO
+SAMPLING = {'sonar': 5}  # subsystem: only one in this many of its debug records is written
+RATE_LIMIT = 10  # Records per second of one message, the others are counted
+QUEUE_SIZE = 4096  # Records waiting for the listener, new records are dropped beyond this
+FORMAT = '%(asctime)s.%(msecs)03d %(levelname)-7s %(name)s: %(message)s'
+DATE_FORMAT = '%H:%M:%S'
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ Puts records on the queue as they are, drops them when it is full """
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The listener runs in this process, formatting is left to it
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class Listener(logging.handlers.QueueListener):
+    """ QueueListener that can stop while the queue is full """
+
+    def enqueue_sentinel(self):
+        # The listener thread is still draining the queue, so this returns
+        self.queue.put(self._sentinel)
+
+
+class SamplingFilter(logging.Filter):
+    """ Only lets one in every SAMPLING debug records of a subsystem through """
+
+    def __init__(self, sampling):
+        """ :param sampling: dictionary subsystem: one in this many debug records is written """
+        super().__init__()
+        self.sampling = {'%s.%s' % (ROOT, subsystem): every for subsystem, every in sampling.items()}
+        self.seen = {}  # logger name: debug records seen
+        self.sampled = 0
+
+    def filter(self, record):
+        every = self.sampling.get(record.name)
+        if every is None or record.levelno != logging.DEBUG:
+            return True
+        seen = self.seen[record.name] = self.seen.get(record.name, 0) + 1
+        if (seen - 1) % every:
+            self.sampled += 1
+            return False
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """ Lets RATE_LIMIT records of a message through per second
+
+    The number suppressed is added to the next record of that message
+    """
+
+    def __init__(self, limit=RATE_LIMIT):
+        super().__init__()
+        self.limit = limit
+        self.rates = {}  # (logger name, message): [second, records in it, suppressed]
+        self.suppressed = 0
+
+    def filter(self, record):
+        second = int(record.created)
+        key = (record.name, record.msg)
+        rate = self.rates.get(key)
+        if rate is None or rate[0] != second:
+            suppressed = rate[2] if rate else 0
+            rate = self.rates[key] = [second, 0, suppressed]
+        if rate[1] >= self.limit:
+            rate[2] += 1
+            self.suppressed += 1
+            return False
+        rate[1] += 1
+        if rate[2]:
+            record.msg = '%s (%d similar suppressed)' % (record.msg, rate[2])
+            rate[2] = 0
+        return True
+
+
+_queue = queue.Queue(QUEUE_SIZE)
+_handler = DroppingQueueHandler(_queue)
+_sampling = SamplingFilter(SAMPLING)
+_rate_limit = RateLimitFilter()
+_listener = None
+
+_root = logging.getLogger(ROOT)
+_root.setLevel(DEFAULT_LEVEL)
+_root.addHandler(_handler)
+_root.propagate = False
+
+
+def get(subsystem):
+    """ Returns the logging.Logger of a subsystem """
+    return logging.getLogger('%s.%s' % (ROOT, subsystem))
+
+
+def start(stream=None):
+    """ Start the listener thread that writes the records, unless it runs already
+
+    :param stream: File to write to, sys.stdout by default
+    """
+    global _listener
+    if _listener is not None:
+        return
+    # FORMAT has no source location, thread or process. Not looking them
+    # up halves the cost of a record, see Optimization in the logging HOWTO
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    console = logging.StreamHandler(stream or sys.stdout)
+    console.setFormatter(logging.Formatter(FORMAT, DATE_FORMAT))
+    console.addFilter(_sampling)
+    console.addFilter(_rate_limit)
+    _listener = Listener(_queue, console)
+    _listener.start()
+
+
+def stop():
+    """ Write the records that are left and stop the listener thread """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def set_level(level, subsystem=None):
+    """ Change the level of a subsystem, or the default level of all of them
+
+    :param level: logging.DEBUG, INFO, WARNING, ERROR or the name of one
+    :param subsystem: The subsystem, None for all of them
+    """
+    if isinstance(level, str):
+        level = level.upper()
+    (get(subsystem) if subsystem else _root).setLevel(level)
+
+
+def configure(spec):
+    """ Set the levels from text like 'info,autonomous=debug,sonar=debug'
+
+    An entry without a subsystem sets the default level
+    """
+    for entry in filter(None, (entry.strip() for entry in spec.split(','))):
+        subsystem, _, level = entry.rpartition('=')
+        set_level(level, subsystem or None)
+
+
+def stats():
+    """ Returns the counters of the records not written as text """
+    return '%d dropped, %d sampled out, %d rate limited' % (
+        _handler.dropped, _sampling.sampled, _rate_limit.suppressed)
+
+
+if __name__ == '__main__':
+    import io
+    import timeit
+
+    log = get('benchmark')
+    number = 1000  # Calls between two drains, well below QUEUE_SIZE
+    output = io.StringIO()
+    for level in (logging.INFO, logging.DEBUG):
+        set_level(level)
+        start(output)
+        # The listener drains the queue between the repeats
+        seconds = min(timeit.repeat(lambda: log.debug('Distance: %s', 42), lambda: time.sleep(0.01),
+                                    number=number, repeat=50))
+        stop()
+        print('debug at level {:<7} {:.2f} us/call'.format(logging.getLevelName(level), seconds / number * 1e6))
+
+    def print_debug():
+        print('{} DEBUG benchmark: Distance: {}'.format(time.strftime('%H:%M:%S'), 42), file=output)
+    seconds = min(timeit.repeat(print_debug, number=number, repeat=50))
+    print('print to memory          {:.2f} us/call'.format(seconds / number * 1e6))
+    print('Logging: %s' % stats())
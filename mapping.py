@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+""" Occupancy grid mapping from the sonar and dead reckoning
+
+The pose of the robot is estimated from the wheel speeds DcMotors
+commands. Every sonar reading marks the cells in the sonar cone up
+to the measured distance as free and the cells at that distance as
+occupied, in log-odds so repeated readings add up.
+"""
+
+import math
+import numpy
+from dc_motors import CM_PER_SECOND_PER_PWM, TRACK_WIDTH
+from sonar import MAX_SONAR_DISTANCE
+
+# Global Definitions
+CELL_SIZE = 5  # cm
+GRID_SIZE = 400  # Cells along each side, the robot starts in the middle
+SONAR_CONE = math.radians(15)  # Half the opening angle of the HC-SR04 beam
+HEADING_STEPS = 360  # The cone masks are precomputed for this many headings
+
+LOG_ODDS_FREE = -0.4  # Added to a cell the sonar looked through
+LOG_ODDS_OCCUPIED = 0.85  # Added to a cell at the measured distance
+LOG_ODDS_LIMIT = 5.0  # Cells saturate here, so the map can still change
+OCCUPIED = 0.5  # Cells above this log-odds block a direction
+
+LOOKAHEAD = 100  # cm ahead checked for a free direction
+
+# Directions the autonomous driver can turn, name: angle from the heading
+TURN_DIRECTIONS = {'left': math.pi / 2, 'right': -math.pi / 2}
+
+
+class DeadReckoning:
+    """ Estimate the pose from the commanded wheel speeds
+
+    The speeds only change when DcMotors writes new ones, so between
+    two changes the robot drives an exact arc. It uses the same
+    skid-steer model as dc_motors.twist_to_wheels.
+    """
+
+    def __init__(self, clock, pose=(0.0, 0.0, 0.0), cm_per_pwm=CM_PER_SECOND_PER_PWM,
+                 track_width=TRACK_WIDTH):
+        """ Initialise the estimate
+
+        :param clock: function returning the time in seconds, the loop time
+        :param pose: Starting (x, y in cm, heading in radians), 0 is along x
+        :param cm_per_pwm: Ground speed of a wheel per unit of PWM
+        :param track_width: Distance between the left and right wheels in cm
+        """
+        self.clock = clock
+        self.x, self.y, self.heading = pose
+        self.cm_per_pwm = cm_per_pwm
+        self.track_width = track_width
+        self._left = 0.0
+        self._right = 0.0
+        self._time = clock()
+
+    def speeds_changed(self, speeds):
+        """ DcMotors listener, takes the speeds in WHEELS order """
+        self._advance()
+        self._left = (speeds[0] + speeds[1]) / 2 * self.cm_per_pwm
+        self._right = (speeds[2] + speeds[3]) / 2 * self.cm_per_pwm
+
+    def _advance(self):
+        """ Move the estimate along the current arc up to now """
+        now = self.clock()
+        elapsed = now - self._time
+        self._time = now
+        if elapsed <= 0:
+            return
+
+        speed = (self._left + self._right) / 2
+        rotation = (self._right - self._left) / self.track_width
+        if abs(rotation) < 1e-9:
+            self.x += speed * elapsed * math.cos(self.heading)
+            self.y += speed * elapsed * math.sin(self.heading)
+        else:
+            radius = speed / rotation
+            heading = self.heading + rotation * elapsed
+            self.x += radius * (math.sin(heading) - math.sin(self.heading))
+            self.y -= radius * (math.cos(heading) - math.cos(self.heading))
+            self.heading = heading
+
+    @property
+    def pose(self):
+        """ The estimated (x, y, heading) now """
+        self._advance()
+        return self.x, self.y, self.heading
+
+
+class OccupancyGrid:
+    """ Log-odds occupancy grid
+
+    The distance from a cell to every cell around it within sonar
+    range, and which of those cells are in the sonar cone for each of
+    HEADING_STEPS headings, are computed once. An update only compares
+    the distances with the reading, over the part of the window the
+    reading reaches.
+    """
+
+    def __init__(self, size=GRID_SIZE, cell_size=CELL_SIZE, max_range=MAX_SONAR_DISTANCE, cone=SONAR_CONE):
+        """ Initialise an unknown grid
+
+        :param size: Cells along each side
+        :param cell_size: Size of a cell in cm
+        :param max_range: The maximum distance in cm the sonar reads
+        :param cone: Half the opening angle of the sonar in radians
+        """
+        self.size = size
+        self.cell_size = cell_size
+        self.cone = cone
+        self.origin = size // 2  # Row and column of x, y = 0, 0
+        self.log_odds = numpy.zeros((size, size), numpy.float32)
+
+        # Distances from the center of the window, rows are y
+        self._radius = int(math.ceil(max_range / cell_size)) + 1
+        offsets = numpy.arange(-self._radius, self._radius + 1) * float(cell_size)
+        dx, dy = numpy.meshgrid(offsets, offsets)
+        self._ranges = numpy.hypot(dx, dy).astype(numpy.float32)
+
+        # Cone masks for every heading step, the center cell is in all of them
+        angles = numpy.arctan2(dy, dx)
+        headings = numpy.arange(HEADING_STEPS) * (2 * math.pi / HEADING_STEPS)
+        bearings = numpy.abs((angles[None] - headings[:, None, None] + math.pi) % (2 * math.pi) - math.pi)
+        self._cones = bearings <= cone
+        self._cones[:, self._radius, self._radius] = True
+
+    def cell(self, x, y):
+        """ Returns the (row, column) of a position in cm """
+        return (self.origin + int(round(y / self.cell_size)),
+                self.origin + int(round(x / self.cell_size)))
+
+    def _window(self, row, col, reach):
+        """ Returns the grid and window slices of the cells within reach cells of row, col """
+        reach = min(reach, self._radius)
+        top, bottom = max(row - reach, 0), min(row + reach + 1, self.size)
+        left, right = max(col - reach, 0), min(col + reach + 1, self.size)
+        if top >= bottom or left >= right:
+            return None
+        offset_row, offset_col = self._radius - row, self._radius - col
+        return ((slice(top, bottom), slice(left, right)),
+                (slice(top + offset_row, bottom + offset_row), slice(left + offset_col, right + offset_col)))
+
+    def update(self, pose, distance, max_distance=MAX_SONAR_DISTANCE):
+        """ Add a sonar reading
+
+        :param pose: (x, y, heading) of the sonar
+        :param distance: The measured distance in cm
+        :param max_distance: Readings this far or further saw nothing
+        """
+        x, y, heading = pose
+        half_cell = self.cell_size / 2
+        reach = int(math.ceil((min(distance, max_distance) + half_cell) / self.cell_size)) + 1
+        slices = self._window(*self.cell(x, y), reach)
+        if slices is None:
+            return
+        grid, window = slices
+
+        ranges = self._ranges[window]
+        in_cone = self._cones[int(round(heading / (2 * math.pi) * HEADING_STEPS)) % HEADING_STEPS][window]
+
+        region = self.log_odds[grid]
+        numpy.add(region, LOG_ODDS_FREE, out=region, where=in_cone & (ranges < distance - half_cell))
+        if distance < max_distance:
+            numpy.add(region, LOG_ODDS_OCCUPIED, out=region,
+                      where=in_cone & (numpy.abs(ranges - distance) <= half_cell))
+        numpy.clip(region, -LOG_ODDS_LIMIT, LOG_ODDS_LIMIT, out=region)
+
+    def clearance(self, pose, angle, lookahead=LOOKAHEAD):
+        """ Returns the free distance in cm in a direction
+
+        :param pose: (x, y, heading) of the robot
+        :param angle: Direction relative to the heading in radians
+        :param lookahead: The furthest distance checked
+        """
+        x, y, heading = pose
+        direction = heading + angle
+        step = self.cell_size / 2
+        steps = numpy.arange(1, int(lookahead / step) + 1) * step
+        rows = self.origin + numpy.rint((y + steps * math.sin(direction)) / self.cell_size).astype(int)
+        cols = self.origin + numpy.rint((x + steps * math.cos(direction)) / self.cell_size).astype(int)
+
+        # Off the map counts as blocked
+        blocked = (rows < 0) | (rows >= self.size) | (cols < 0) | (cols >= self.size)
+        inside = ~blocked
+        blocked[inside] = self.log_odds[rows[inside], cols[inside]] > OCCUPIED
+        if not blocked.any():
+            return lookahead
+        return float(steps[blocked.argmax()] - step)
+
+    def free_direction(self, pose, directions=TURN_DIRECTIONS, lookahead=LOOKAHEAD):
+        """ Returns the name of the direction with the most room
+
+        :param pose: (x, y, heading) of the robot
+        :param directions: dictionary name: angle relative to the heading
+        :param lookahead: The furthest distance checked
+        :returns: the name, None when the best directions are equally free
+        """
+        clearances = sorted(((self.clearance(pose, angle, lookahead), name)
+                             for name, angle in directions.items()), reverse=True)
+        if len(clearances) > 1 and clearances[0][0] == clearances[1][0]:
+            return None
+        return clearances[0][1]
+
+    def probabilities(self):
+        """ Returns the occupancy probability of every cell """
+        return 1 - 1 / (1 + numpy.exp(self.log_odds))
+
+
+class Mapper:
+    """ Builds an occupancy grid while driving """
+
+    def __init__(self, dc_motors, sonar, clock, grid=None, mount_angle=0.0):
+        """ Start mapping
+
+        :param dc_motors: The DcMotors, its speeds drive the dead reckoning
+        :param sonar: The Sonar to map with
+        :param clock: function returning the time in seconds, the loop time
+        :param grid: The OccupancyGrid to fill, a new one by default
+        :param mount_angle: Angle of the sonar relative to the heading in radians
+        """
+        self.dead_reckoning = DeadReckoning(clock)
+        self.dead_reckoning.speeds_changed(dc_motors.speeds)
+        self.grid = grid or OccupancyGrid(max_range=sonar.max_distance)
+        self.mount_angle = mount_angle
+        self.updates = 0
+
+        dc_motors.add_listener(self.dead_reckoning.speeds_changed)
+        sonar.add_listener(self._sonar_updated)
+
+    def _sonar_updated(self, sonar):
+        x, y, heading = self.dead_reckoning.pose
+        self.grid.update((x, y, heading + self.mount_angle), sonar.reading, sonar.max_distance)
+        self.updates += 1
+
+    def free_direction(self, directions=TURN_DIRECTIONS):
+        """ Returns the name of the direction with the most room, None on a tie """
+        return self.grid.free_direction(self.dead_reckoning.pose, directions)
+
+
+if __name__ == '__main__':
+    import timeit
+
+    grid = OccupancyGrid()
+    number = 10000
+    for distance in (30, 100, MAX_SONAR_DISTANCE):
+        seconds = timeit.timeit(lambda: grid.update((0.0, 0.0, 0.3), distance), number=number)
+        print('update at {:>3} cm on a {}x{} grid: {:.1f} us'.format(distance, grid.size, grid.size,
+                                                                       seconds / number * 1e6))
+    seconds = timeit.timeit(lambda: grid.free_direction((0.0, 0.0, 0.3)), number=number)
+    print('free_direction: {:.1f} us'.format(seconds / number * 1e6))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+""" Low overhead latency histograms with a Prometheus text endpoint
+
+Instrumented code reads the clock and observes a histogram only when
+ENABLED is set, so with the kill switch off a stage costs one global
+lookup:
+
+    if metrics.ENABLED:
+        started = metrics.clock()
+    ...
+    if metrics.ENABLED:
+        EVDEV_READ.observe_since(started)
+"""
+
+import asyncio
+import time
+from bisect import bisect_left
+
+# Global Definitions
+ENABLED = False  # Kill switch, nothing is measured while this is False
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9105
+
+# Bucket upper bounds in seconds, from 10 us to 1 s
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+clock = time.perf_counter
+
+
+class Histogram:
+    """ Latency histogram with fixed buckets """
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        """ Initialise the histogram
+
+        :param name: Prometheus metric name
+        :param help_text: Description shown in the endpoint
+        :param buckets: Sorted upper bounds of the buckets in seconds
+        """
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.reset()
+
+    def reset(self):
+        """ Clear all observations """
+        # One extra count for observations above the last bound (+Inf)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        """ Add an observation """
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def observe_since(self, started):
+        """ Add the time passed since started, a clock() value """
+        self.observe(clock() - started)
+
+    def exposition(self):
+        """ Returns the histogram in the Prometheus text format """
+        lines = ['# HELP {} {}'.format(self.name, self.help_text),
+                 '# TYPE {} histogram'.format(self.name)]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound, cumulative))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(self.name, self.count))
+        lines.append('{}_sum {}'.format(self.name, self.total))
+        lines.append('{}_count {}'.format(self.name, self.count))
+        return '\n'.join(lines)
+
+
+REGISTRY = []
+
+
+def histogram(name, help_text, buckets=DEFAULT_BUCKETS):
+    """ Create a histogram and add it to the endpoint """
+    new_histogram = Histogram(name, help_text, buckets)
+    REGISTRY.append(new_histogram)
+    return new_histogram
+
+
+# The stages of the control path
+EVDEV_READ = histogram('robot_evdev_read_seconds',
+                       'Time to decode one batch of controller events')
+SONAR_CONSUME = histogram('robot_sonar_consume_seconds',
+                          'Time from the sonar callback until the sonar task used the reading')
+DECISION = histogram('robot_decision_seconds',
+                     'Time spent in the driving logic of one control cycle')
+FIRMATA_WRITE = histogram('robot_firmata_write_seconds',
+                          'Time to flush the pending motor pin values to the board')
+SONAR_DETECTION = histogram('robot_sonar_detection_seconds',
+                            'Time from the ping before the first sonar reading below a threshold '
+                            'until the filtered distance crossed it')
+
+
+def exposition():
+    """ Returns all histograms in the Prometheus text format """
+    return '\n'.join(registered.exposition() for registered in REGISTRY) + '\n'
+
+
+def enable():
+    """ Turn instrumentation on """
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    """ Turn instrumentation off, the histograms keep their data """
+    global ENABLED
+    ENABLED = False
+
+
+async def _handle_request(reader, writer):
+    """ Answer one HTTP request with the metrics """
+    try:
+        request = await reader.readline()
+        # Skip the headers
+        while (await reader.readline()).strip():
+            pass
+
+        if request.split()[1:2] == [b'/metrics']:
+            status, body = '200 OK', exposition()
+        else:
+            status, body = '404 Not Found', 'Not found\n'
+        body = body.encode()
+        writer.write('HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                     'Content-Length: {}\r\n\r\n'.format(status, len(body)).encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_server(host=METRICS_HOST, port=METRICS_PORT, path=None):
+    """ Serve the metrics on http://host:port/metrics
+
+    :param host: Address to listen on, local only by default
+    :param port: TCP port to listen on
+    :param path: Listen on this Unix socket instead of TCP
+    :returns: the asyncio Server
+    """
+    if path:
+        return await asyncio.start_unix_server(_handle_request, path)
+    return await asyncio.start_server(_handle_request, host, port)
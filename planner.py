@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+
+""" Route planning off the control loop
+
+Plans are made in a pool of worker processes, the control loop only
+takes a snapshot of the occupancy grid and picks up finished plans.
+The snapshots are written to a shared memory block the workers map,
+so handing one over costs a copy instead of pickling the grid.
+
+A plan is a wavefront search over the grid around the robot, to the
+closest part of the map that was never seen, preferring the ones
+ahead of the robot.
+"""
+
+import asyncio
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy
+from mapping import OCCUPIED
+
+# Global Definitions
+PLAN_WORKERS = 2  # Worker processes, the Raspberry Pi keeps two cores for the rest
+PLAN_INTERVAL = 0.25  # Seconds between plans while driving autonomously
+PLAN_MAX_AGE = 1.0  # Seconds a plan is used after it was requested
+PLAN_RADIUS = 150  # cm around the robot the planner searches
+ROBOT_RADIUS = 12  # cm, obstacles are grown by this so the path is for the center of the robot
+UNKNOWN = 0.2  # Cells with log-odds closer than this to 0 were never seen
+MIN_GOAL_DISTANCE = 30  # cm, unseen cells closer than this are around the robot, not ahead
+TURN_COST = 40  # cm a goal may be further away per radian less to turn
+WAYPOINT_DISTANCE = 30  # cm along the path the heading of a plan points to
+
+# Shared memory blocks mapped by this worker process, name: SharedMemory
+_attached = {}
+
+
+class Plan:
+    """ A path to the closest unseen part of the map """
+
+    def __init__(self, pose, path, requested=None):
+        """ Initialise the plan
+
+        :param pose: The (x, y, heading) the plan starts from
+        :param path: list of (x, y) in cm from the robot to the goal
+        :param requested: Loop time the plan was requested
+        """
+        self.pose = pose
+        self.path = path
+        self.requested = requested
+
+        # Angle from the heading to the point WAYPOINT_DISTANCE along the path
+        x, y, heading = pose
+        waypoint_x, waypoint_y = path[-1]
+        for waypoint_x, waypoint_y in path:
+            if math.hypot(waypoint_x - x, waypoint_y - y) >= WAYPOINT_DISTANCE:
+                break
+        angle = math.atan2(waypoint_y - y, waypoint_x - x) - heading
+        self.heading = (angle + math.pi) % (2 * math.pi) - math.pi
+
+    @property
+    def turn_direction(self):
+        """ The side the path leaves to, left or right """
+        return 'left' if self.heading > 0 else 'right'
+
+    def __repr__(self):
+        return 'Plan(%d cm, heading %.0f degrees)' % (
+            sum(math.hypot(x2 - x1, y2 - y1) for (x1, y1), (x2, y2) in zip(self.path, self.path[1:])),
+            math.degrees(self.heading))
+
+
+def _grow(mask, cells=1):
+    """ Returns mask with every True cell grown by cells in all 8 directions """
+    grown = mask.copy()
+    for _ in range(cells):
+        grown[1:] |= grown[:-1]
+        grown[:-1] |= grown[1:]
+        grown[:, 1:] |= grown[:, :-1]
+        grown[:, :-1] |= grown[:, 1:]
+    return grown
+
+
+def find_route(log_odds, cell_size, pose, radius=PLAN_RADIUS, robot_radius=ROBOT_RADIUS):
+    """ Plan a path to the closest unseen part of the map
+
+    :param log_odds: The log-odds of an OccupancyGrid, x, y = 0, 0 in the middle
+    :param cell_size: Size of a cell in cm
+    :param pose: (x, y, heading) to plan from
+    :param radius: Distance in cm around the pose that is searched
+    :param robot_radius: Obstacles are grown by this many cm
+    :returns: the Plan, None when nothing unseen can be reached
+    """
+    size = log_odds.shape[0]
+    origin = size // 2
+    x, y, heading = pose
+    row, col = origin + int(round(y / cell_size)), origin + int(round(x / cell_size))
+    reach = int(radius / cell_size)
+    top, left = max(row - reach, 0), max(col - reach, 0)
+    local = log_odds[top:min(row + reach + 1, size), left:min(col + reach + 1, size)]
+    row, col = row - top, col - left
+    if not (0 <= row < local.shape[0] and 0 <= col < local.shape[1]):
+        return None
+
+    passable = ~_grow(local > OCCUPIED, int(math.ceil(robot_radius / cell_size)))
+    unseen = numpy.abs(local) < UNKNOWN
+
+    # Wavefront: the number of steps from the robot to every cell it can reach
+    steps = numpy.full(local.shape, -1, numpy.int32)
+    steps[row, col] = 0
+    reached = steps == 0
+    front = reached
+    step = 0
+    while front.any():
+        step += 1
+        front = _grow(front) & passable & ~reached
+        steps[front] = step
+        reached |= front
+
+    # The goal is the closest reachable unseen cell, costs for turning included
+    rows, cols = numpy.indices(local.shape)
+    dx, dy = (cols - col) * cell_size, (rows - row) * cell_size
+    turn = numpy.abs((numpy.arctan2(dy, dx) - heading + math.pi) % (2 * math.pi) - math.pi)
+    cost = steps * cell_size + TURN_COST * turn
+    candidates = reached & unseen & (numpy.hypot(dx, dy) >= MIN_GOAL_DISTANCE)
+    if not candidates.any():
+        return None
+    goal = numpy.unravel_index(numpy.where(candidates, cost, numpy.inf).argmin(), local.shape)
+
+    # Walk the wavefront back down to the robot
+    path = [goal]
+    current = goal
+    while steps[current] > 0:
+        r, c = current
+        current = next((r + dr, c + dc) for dr in (-1, 0, 1) for dc in (-1, 0, 1)
+                       if 0 <= r + dr < local.shape[0] and 0 <= c + dc < local.shape[1] and
+                       steps[r + dr, c + dc] == steps[current] - 1)
+        path.append(current)
+    path.reverse()
+    return Plan(pose, [((c + left - origin) * cell_size, (r + top - origin) * cell_size) for r, c in path])
+
+
+def _snapshot(name, offset, size):
+    """ Map a snapshot in a shared memory block, keeps the block mapped for the next plans """
+    block = _attached.get(name)
+    if block is None:
+        block = _attached[name] = shared_memory.SharedMemory(name=name)
+    return numpy.ndarray((size, size), numpy.float32, block.buf, offset)
+
+
+def plan_route(name, offset, size, cell_size, pose):
+    """ Worker side of Planner: find_route over a snapshot in shared memory """
+    return find_route(_snapshot(name, offset, size), cell_size, pose)
+
+
+class Planner:
+    """ Plans routes over an occupancy grid in worker processes
+
+    Every plan works on its own snapshot of the grid. The shared block
+    has a slot per worker and a spare, so taking a snapshot never waits
+    for a running plan. Requesting a plan replaces the last request:
+    when that did not start yet it is dropped, when it is running its
+    result is ignored.
+    """
+
+    def __init__(self, grid, loop=None, workers=PLAN_WORKERS, executor=None):
+        """ Initialise the planner. Call start from the asyncio loop
+
+        :param grid: The mapping.OccupancyGrid to plan over
+        :param loop: The asyncio loop
+        :param workers: The number of worker processes
+        :param executor: concurrent.futures.Executor to plan in instead of a process pool
+        """
+        self.grid = grid
+        self.loop = loop or asyncio.get_event_loop()
+        self.workers = workers
+        self._own_executor = executor is None
+        if executor is None:
+            # The workers are started from a clean process, the robot has threads running
+            executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('forkserver'))
+        self.executor = executor
+
+        slots = workers + 1
+        self._shared = shared_memory.SharedMemory(create=True, size=slots * grid.log_odds.nbytes)
+        self._free_slots = list(range(slots))
+        self._waiting = None  # (future, pose) of a request waiting for a free slot
+
+        self.current = None  # The future of the last plan requested
+        self.latest = None  # The last Plan made
+        self.plans = 0
+        self.replaced = 0
+        self.failed = 0
+
+    async def start(self):
+        """ Start the workers and map the shared block in each of them
+
+        Starting a worker process blocks, so that is done from the default executor
+        """
+        jobs = await self.loop.run_in_executor(None, self._start_workers)
+        await asyncio.gather(*(asyncio.wrap_future(job, loop=self.loop) for job in jobs),
+                             return_exceptions=True)
+
+    def _start_workers(self):
+        return [self.executor.submit(_snapshot, self._shared.name, 0, self.grid.size)
+                for _ in range(self.workers)]
+
+    def plan(self, pose):
+        """ Request a plan, replaces the last request
+
+        Returns right away, the control loop never waits for a plan.
+
+        :param pose: (x, y, heading) to plan from
+        :returns: future of the Plan, or of None when nothing unseen can
+                  be reached. Cancelling it cancels the plan
+        """
+        if self.current and not self.current.done():
+            self.current.cancel()
+            self.replaced += 1
+        future = self.current = self.loop.create_future()
+        if self._free_slots:
+            self._submit(future, pose)
+        else:
+            self._waiting = (future, pose)
+        return future
+
+    def fresh_plan(self, max_age=PLAN_MAX_AGE):
+        """ Returns the latest Plan if it was requested at most max_age seconds ago """
+        if self.latest and self.loop.time() - self.latest.requested <= max_age:
+            return self.latest
+        return None
+
+    def _submit(self, future, pose):
+        slot = self._free_slots.pop()
+        offset = slot * self.grid.log_odds.nbytes
+        snapshot = numpy.ndarray(self.grid.log_odds.shape, numpy.float32, self._shared.buf, offset)
+        snapshot[:] = self.grid.log_odds
+        requested = self.loop.time()
+
+        job = self.executor.submit(plan_route, self._shared.name, offset, self.grid.size,
+                                   self.grid.cell_size, pose)
+        # The slot is free again when the worker is done with it, not when the future is
+        job.add_done_callback(lambda job: self.loop.call_soon_threadsafe(
+            self._job_done, job, slot, future, requested))
+        future.add_done_callback(lambda future: future.cancelled() and job.cancel())
+
+    def _job_done(self, job, slot, future, requested):
+        self._free_slots.append(slot)
+        if not future.done():
+            if job.cancelled():
+                future.cancel()
+            elif job.exception():
+                self.failed += 1
+                future.set_exception(job.exception())
+            else:
+                plan = job.result()
+                if plan:
+                    plan.requested = requested
+                    self.latest = plan
+                self.plans += 1
+                future.set_result(plan)
+
+        if self._waiting:
+            future, pose = self._waiting
+            self._waiting = None
+            if not future.done():
+                self._submit(future, pose)
+
+    async def run(self, pose, active=None, interval=PLAN_INTERVAL):
+        """ Planning task, requests a new plan every interval seconds
+
+        :param pose: function returning the (x, y, heading) to plan from
+        :param active: function returning whether plans are needed now, always by default
+        :param interval: Seconds between plans
+        """
+        while True:
+            if active is None or active():
+                self.plan(pose())
+            await asyncio.sleep(interval)
+
+    def close(self):
+        """ Stop the workers and free the shared block """
+        if self.current:
+            self.current.cancel()
+        if self._own_executor:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+        self._shared.close()
+        self._shared.unlink()
+
+    def __str__(self):
+        return '%d plans, %d replaced, %d failed' % (self.plans, self.replaced, self.failed)
+
+
+if __name__ == '__main__':
+    import timeit
+    from mapping import OccupancyGrid
+
+    # A room of 240 by 160 cm around the robot with a doorway to the
+    # back left, seen from the middle
+    grid = OccupancyGrid()
+    for angle in numpy.linspace(-math.pi, math.pi, 720):
+        distance = min(abs(120 / math.cos(angle)) if math.cos(angle) else 1e9,
+                       abs(80 / math.sin(angle)) if math.sin(angle) else 1e9)
+        if abs(angle - 2.2) < 0.15:
+            distance = grid.size  # Nothing there
+        for _ in range(3):
+            grid.update((0.0, 0.0, angle), distance)
+
+    pose = (0.0, 0.0, 0.3)
+    print(find_route(grid.log_odds, grid.cell_size, pose))
+    number = 100
+    seconds = timeit.timeit(lambda: find_route(grid.log_odds, grid.cell_size, pose), number=number)
+    print('find_route over {} cm: {:.1f} ms'.format(PLAN_RADIUS, seconds / number * 1e3))
+
+    async def request_plans(planner, count):
+        await planner.start()
+        started = loop.time()
+        for _ in range(count):
+            await planner.plan(pose)
+        return (loop.time() - started) / count
+
+    loop = asyncio.get_event_loop()
+    planner = Planner(grid, loop)
+    print('Plan through the process pool: {:.1f} ms'.format(loop.run_until_complete(request_plans(planner, 50)) * 1e3))
+    planner.close()
@@ -2,153 +2,501 @@
 
 import asyncio
 import evdev
+import logger
+import metrics
+from telemetry import CONTROLLER
+
+
+# Global Definitions
+# The buttons and axes every controller layout is decoded into. The
+# position in these tuples is the slot of the button or axis in the
+# state arrays of RemoteControl
+BUTTONS = ('SELECT', 'START', 'LEFT_STICK', 'RIGHT_STICK', 'LEFT', 'UP',
+           'RIGHT', 'DOWN', 'PS', 'SQUARE', 'TRIANGLE', 'CIRCLE', 'CROSS',
+           'R1', 'R2', 'L1', 'L2')
+AXES = ('LEFT_AXIS_X', 'LEFT_AXIS_Y', 'RIGHT_AXIS_X', 'RIGHT_AXIS_Y')
+
+BUTTON_SLOTS = {name: slot for slot, name in enumerate(BUTTONS)}
+AXIS_SLOTS = {name: slot for slot, name in enumerate(AXES)}
+
+LONG_PRESS_TIME = 1.0  # Seconds a button has to be held for a long press
+
+# Seconds between attempts to find the controller, doubling up to the
+# maximum so a controller that comes back is in use within a second
+RECONNECT_MIN_DELAY = 0.05
+RECONNECT_MAX_DELAY = 0.5
+
+
+class ControllerMapping:
+    """ Describes how the evdev codes of a controller map onto BUTTONS and AXES """
+
+    def __init__(self, name, buttons, axes, hats=None, axis_range=(0, 255), names=()):
+        """ Precompute the code to slot lookup tables
+
+        :param name: Name of the controller layout
+        :param buttons: dictionary EV_KEY code: button name
+        :param axes: dictionary EV_ABS code: axis name
+        :param hats: dictionary EV_ABS code: (negative button, positive button)
+                     for D-pads that report as a hat axis
+        :param axis_range: (minimum, maximum) raw value of the axes, used
+                           for devices that don't report their own
+        :param names: Parts of the evdev device names of controllers with this layout
+        """
+        self.name = name
+        self.names = names
+        self.axis_range = axis_range
+        self.button_slots = {code: BUTTON_SLOTS[button] for code, button in buttons.items()}
+        self.axis_slots = {code: AXIS_SLOTS[axis] for code, axis in axes.items()}
+        self.hat_slots = {code: (BUTTON_SLOTS[negative], BUTTON_SLOTS[positive])
+                          for code, (negative, positive) in (hats or {}).items()}
+
+
+PS3_MAPPING = ControllerMapping(
+    'PS3',
+    buttons={288: 'SELECT', 291: 'START', 289: 'LEFT_STICK', 290: 'RIGHT_STICK',
+             295: 'LEFT', 292: 'UP', 293: 'RIGHT', 294: 'DOWN', 704: 'PS',
+             303: 'SQUARE', 300: 'TRIANGLE', 301: 'CIRCLE', 302: 'CROSS',
+             299: 'R1', 297: 'R2', 298: 'L1', 296: 'L2'},
+    # Right stick Y axis is 5, yes 5...
+    axes={0: 'LEFT_AXIS_X', 1: 'LEFT_AXIS_Y', 2: 'RIGHT_AXIS_X', 5: 'RIGHT_AXIS_Y'},
+    names=('PLAYSTATION(R)3',))
+
+DS4_MAPPING = ControllerMapping(
+    'DS4',
+    buttons={314: 'SELECT', 315: 'START', 317: 'LEFT_STICK', 318: 'RIGHT_STICK',
+             316: 'PS', 308: 'SQUARE', 307: 'TRIANGLE', 305: 'CIRCLE', 304: 'CROSS',
+             311: 'R1', 313: 'R2', 310: 'L1', 312: 'L2'},
+    axes={0: 'LEFT_AXIS_X', 1: 'LEFT_AXIS_Y', 3: 'RIGHT_AXIS_X', 4: 'RIGHT_AXIS_Y'},
+    hats={16: ('LEFT', 'RIGHT'), 17: ('UP', 'DOWN')},
+    names=('Wireless Controller',))
+
+XBOX_MAPPING = ControllerMapping(
+    'Xbox',
+    buttons={314: 'SELECT', 315: 'START', 317: 'LEFT_STICK', 318: 'RIGHT_STICK',
+             316: 'PS', 307: 'SQUARE', 308: 'TRIANGLE', 305: 'CIRCLE', 304: 'CROSS',
+             311: 'R1', 310: 'L1'},
+    axes={0: 'LEFT_AXIS_X', 1: 'LEFT_AXIS_Y', 3: 'RIGHT_AXIS_X', 4: 'RIGHT_AXIS_Y'},
+    hats={16: ('LEFT', 'RIGHT'), 17: ('UP', 'DOWN')},
+    axis_range=(-32768, 32767),
+    names=('Xbox', 'X-Box'))
+
+MAPPINGS = (PS3_MAPPING, DS4_MAPPING, XBOX_MAPPING)
+
+log = logger.get('controller')
+
+
+def match_mapping(device, mappings=MAPPINGS):
+    """ Returns the mapping of an input device, None if it is no controller
+
+    The device has to report all axes and at least half of the buttons
+    of the mapping. A mapping matching the device name is preferred,
+    otherwise the one with the most buttons reported is picked. The
+    name alone isn't enough, the motion sensors and touchpad of a pad
+    are separate devices with the same name.
+
+    :param device: An evdev InputDevice
+    :param mappings: The ControllerMappings to choose from
+    """
+    capabilities = device.capabilities()
+    keys = set(capabilities.get(evdev.ecodes.EV_KEY, ()))
+    axes = {code for code, info in capabilities.get(evdev.ecodes.EV_ABS, ())}
+    best, best_score = None, 0
+    for mapping in mappings:
+        if not axes.issuperset(mapping.axis_slots):
+            continue
+        score = len(keys.intersection(mapping.button_slots)) / len(mapping.button_slots)
+        if score < 0.5:
+            continue
+        if any(name in device.name for name in mapping.names):
+            return mapping
+        if score >= best_score:
+            best, best_score = mapping, score
+    return best
+
+
+def axis_ranges(device, mapping):
+    """ Returns the raw range of each axis of a mapping on a device
+
+    The ranges are taken from the AbsInfo the device reports, a pad
+    matched on its capabilities can use other ranges than the layout.
+
+    :param device: An evdev InputDevice
+    :param mapping: The ControllerMapping of the device
+    :returns: dictionary EV_ABS code: (minimum, maximum), axes the device
+              doesn't report a usable range for get mapping.axis_range
+    """
+    reported = dict(device.capabilities().get(evdev.ecodes.EV_ABS, ()))
+    ranges = {}
+    for code in mapping.axis_slots:
+        info = reported.get(code)
+        if info is not None and info.max > info.min:
+            ranges[code] = (info.min, info.max)
+        else:
+            ranges[code] = mapping.axis_range
+    return ranges
+
+
+def find_controller(mappings=MAPPINGS):
+    """ Look for a controller among the input devices
+
+    This opens every input device, run it in an executor.
+
+    :param mappings: The ControllerMappings to look for
+    :returns: (InputDevice, ControllerMapping), or (None, None) when
+              no controller is connected
+    """
+    for path in evdev.list_devices():
+        try:
+            device = evdev.InputDevice(path)
+            mapping = match_mapping(device, mappings)
+        except OSError:
+            continue
+        if mapping:
+            return device, mapping
+        device.close()
+    return None, None
 
 
 class RemoteControl:
-    """ A remote control for handling morTimmy the Robot """
-
-    def __init__(self, input_device='/dev/input/event0', loop=None):
-        """ Connect to controller and define buttons """
-
-        print('Trying to connect to controller...')
-        self.device = evdev.InputDevice(input_device)
-        print(self.device)
-
-        self.LEFT_AXIS_X = 127
-        self.LEFT_AXIS_Y = 127
-        self.RIGHT_AXIS_X = 127
-        self.RIGHT_AXIS_Y = 127
-        self.SELECT = False
-        self.START = False
-        self.LEFT_STICK = False
-        self.RIGHT_STICK = False
-        self.LEFT = False
-        self.UP = False
-        self.RIGHT = False
-        self.DOWN = False
-        self.PS = False
-        self.SQUARE = False
-        self.TRIANGLE = False
-        self.CIRCLE = False
-        self.CROSS = False
-        self.R1 = False
-        self.R2 = False
-        self.L1 = False
-        self.L2 = False
-
-    def _recalc_axis(self, value):
-        """ Recalculates the ps3 axis to a range usable with dc motors
-
-        the PS3 axis reports values between 0-254 with 127 being
-        the center position.
+    """ A remote control for handling morTimmy the Robot
+
+    The state of the buttons and axes is kept in two lists indexed
+    by the slots in BUTTONS and AXES. They can also be read by name,
+    for example controller.SELECT or controller.LEFT_AXIS_X.
+
+    Instead of polling the state, callbacks can be registered for
+    button presses, releases, holds and long presses. These are
+    scheduled on the asyncio loop as soon as the report with the
+    change is decoded.
+
+    When the controller goes away all buttons are released, the
+    axes centered and the disconnect callbacks called. The input
+    task then looks for it again until it is back.
+    """
+
+    def __init__(self, input_device=None, loop=None, mapping=None, device=None):
+        """ Define buttons, the controller is connected by start
+
+        :param input_device: The evdev device of the controller, by
+                             default the first controller found is used
+        :param loop: The asyncio loop
+        :param mapping: The ControllerMapping of the controller layout, by
+                        default the one matching the controller
+        :param device: An already opened input device, input_device is
+                       ignored when this is given
+        """
+        self.input_device = input_device
+        self.device = device
+        self.connected = False
+
+        self.loop = loop or asyncio.get_event_loop()
+        self._fixed_mapping = mapping
+        self._use_mapping(mapping or PS3_MAPPING)
+        self.buttons = [False] * len(BUTTONS)
+        self.axes = [0] * len(AXES)
+
+        # Optional TelemetryRecorder for the raw events
+        self.telemetry = None
+
+        # Changes decoded since the last SYN_REPORT, slot: value
+        self._pending_buttons = {}
+        self._pending_axes = {}
+        self._pending_holds = set()
+
+        # Registered callbacks, slot: [callback, ...]
+        self._press_callbacks = {}
+        self._release_callbacks = {}
+        self._hold_callbacks = {}
+        # slot: [(duration, callback), ...] and the running timers
+        self._long_press_callbacks = {}
+        self._long_press_timers = {}
+        self._connect_callbacks = []
+        self._disconnect_callbacks = []
+
+    def _use_mapping(self, mapping, ranges=None):
+        """ Switch to the layout of a controller
+
+        :param mapping: The ControllerMapping of the layout
+        :param ranges: dictionary EV_ABS code: (minimum, maximum) the
+                       device reports, see axis_ranges. mapping.axis_range
+                       for the axes missing
+        """
+        self.mapping = mapping
+        # EV_ABS code: (slot, minimum, last index, table). The table maps
+        # a raw axis value to -255..255, indexed by value - minimum.
+        # Values outside the range are clamped to it
+        tables = {}
+        self._axes = {}
+        for code, slot in mapping.axis_slots.items():
+            minimum, maximum = (ranges or {}).get(code, mapping.axis_range)
+            if (minimum, maximum) not in tables:
+                tables[(minimum, maximum)] = [self._recalc_axis(value, minimum, maximum)
+                                              for value in range(minimum, maximum + 1)]
+            self._axes[code] = (slot, minimum, maximum - minimum, tables[(minimum, maximum)])
+
+    async def start(self):
+        """ Connect to the controller
+
+        The device is opened in the default executor, so other
+        subsystems can start in the meantime. Without a controller
+        the robot starts anyway, run keeps looking for one.
+        """
+        log.info('Trying to connect to controller...')
+        if not await self._connect():
+            log.info('No controller found, waiting for one to be connected')
+
+    async def _connect(self):
+        """ Open the controller, returns True when it is connected """
+        if self.device is None:
+            if self.input_device:
+                try:
+                    device = await self.loop.run_in_executor(None, evdev.InputDevice, self.input_device)
+                except OSError:
+                    return False
+                mapping = PS3_MAPPING
+            else:
+                device, mapping = await self.loop.run_in_executor(None, find_controller)
+                if device is None:
+                    return False
+            mapping = self._fixed_mapping or mapping
+            try:
+                ranges = await self.loop.run_in_executor(None, axis_ranges, device, mapping)
+            except OSError:
+                device.close()
+                return False
+            self.device = device
+            self._use_mapping(mapping, ranges)
+
+        log.info('Connected to %s', self.device)
+        self.connected = True
+        for callback in self._connect_callbacks:
+            self._dispatch(callback)
+        return True
+
+    def _disconnect(self):
+        """ The controller is gone, return to the neutral state """
+        log.warning('Lost the controller')
+        try:
+            self.device.close()
+        except OSError:
+            pass
+        self.device = None
+        self.connected = False
+
+        self._pending_buttons.clear()
+        self._pending_axes.clear()
+        self._pending_holds.clear()
+        for slot, pressed in enumerate(self.buttons):
+            if pressed:
+                self.buttons[slot] = False
+                self._button_changed(slot, False)
+        self.axes = [0] * len(AXES)
+
+        for callback in self._disconnect_callbacks:
+            self._dispatch(callback)
+
+    def __getattr__(self, name):
+        """ Returns the state of a button or axis by name """
+        slot = BUTTON_SLOTS.get(name)
+        if slot is not None:
+            return self.buttons[slot]
+        slot = AXIS_SLOTS.get(name)
+        if slot is not None:
+            return self.axes[slot]
+        raise AttributeError(name)
+
+    def on_press(self, button, callback):
+        """ Call callback when button goes down
+
+        :param button: name of the button, see BUTTONS
+        :param callback: function or coroutine function without arguments
+        """
+        self._press_callbacks.setdefault(BUTTON_SLOTS[button], []).append(callback)
+
+    def on_release(self, button, callback):
+        """ Call callback when button goes up
+
+        :param button: name of the button, see BUTTONS
+        :param callback: function or coroutine function without arguments
+        """
+        self._release_callbacks.setdefault(BUTTON_SLOTS[button], []).append(callback)
+
+    def on_hold(self, button, callback):
+        """ Call callback on every key repeat while button is held down
+
+        :param button: name of the button, see BUTTONS
+        :param callback: function or coroutine function without arguments
+        """
+        self._hold_callbacks.setdefault(BUTTON_SLOTS[button], []).append(callback)
+
+    def on_long_press(self, button, callback, duration=LONG_PRESS_TIME):
+        """ Call callback once when button is held down for duration seconds
+
+        :param button: name of the button, see BUTTONS
+        :param callback: function or coroutine function without arguments
+        :param duration: seconds the button has to be held down
+        """
+        self._long_press_callbacks.setdefault(BUTTON_SLOTS[button], []).append((duration, callback))
+
+    def on_connect(self, callback):
+        """ Call callback when the controller is connected, also the first time
+
+        :param callback: function or coroutine function without arguments
+        """
+        self._connect_callbacks.append(callback)
+
+    def on_disconnect(self, callback):
+        """ Call callback when the controller is lost
+
+        :param callback: function or coroutine function without arguments
+        """
+        self._disconnect_callbacks.append(callback)
+
+    def _dispatch(self, callback):
+        """ Schedule a callback on the asyncio loop """
+        if asyncio.iscoroutinefunction(callback):
+            self.loop.create_task(callback())
+        else:
+            self.loop.call_soon(callback)
+
+    def _button_changed(self, slot, pressed):
+        """ Dispatch the callbacks for a button that went down or up """
+        if pressed:
+            for callback in self._press_callbacks.get(slot, ()):
+                self._dispatch(callback)
+            self._long_press_timers[slot] = [
+                self.loop.call_later(duration, self._dispatch, callback)
+                for duration, callback in self._long_press_callbacks.get(slot, ())]
+        else:
+            for callback in self._release_callbacks.get(slot, ()):
+                self._dispatch(callback)
+            for timer in self._long_press_timers.pop(slot, ()):
+                timer.cancel()
+
+    def _recalc_axis(self, value, minimum, maximum):
+        """ Recalculates the controller axis to a range usable with dc motors
+
+        the PS3 axis reports values between 0-255 with 127 being
+        the center position, other layouts use other ranges.
 
         dc motors have a range of -255 to 255 with 0 being idle,
         negative numbers reverse.
+
+        :param value: The raw axis value
+        :param minimum: The lowest raw value of the axis
+        :param maximum: The highest raw value of the axis
         """
-        if value == 255:
-            return value
-        elif value >= 127:
-            return value * 2 - 254
+        center = (minimum + maximum) // 2
+        if value >= center:
+            scaled = (value - center) * 255 // (maximum - center)
         else:
-            return value * 2 - 255
+            scaled = (value - center) * 255 // (center - minimum)
+        return max(-255, min(255, scaled))
+
+    async def run(self):
+        """ Controller input task
+
+        Keeps handling evdev events until <START> is pressed. While
+        the controller is not connected it is looked for with an
+        increasing delay, up to RECONNECT_MAX_DELAY.
+        """
+        delay = RECONNECT_MIN_DELAY
+        while not self.START:
+            if not self.connected:
+                if not await self._connect():
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                    continue
+                delay = RECONNECT_MIN_DELAY
+
+            try:
+                await self.handle_events()
+            except OSError:
+                self._disconnect()
 
     async def handle_events(self):
         """
-        Handle a single evdev event, this updates the internal state of the Axis objects as well as calling any
-        registered button handlers.
+        Handle the available evdev events. Changes are collected until
+        the next SYN_REPORT and then applied to the state at once.
         """
         events = await self.device.async_read()
+        if metrics.ENABLED:
+            started = metrics.clock()
+            self.decode(events)
+            metrics.EVDEV_READ.observe_since(started)
+        else:
+            self.decode(events)
+
+    def decode(self, events):
+        """ Decode a batch of evdev events into the button and axis state
+
+        :param events: iterable of evdev InputEvents
+        """
+        button_slots = self.mapping.button_slots
+        axes = self._axes
+        hat_slots = self.mapping.hat_slots
+        pending_buttons = self._pending_buttons
+        pending_axes = self._pending_axes
+        telemetry = self.telemetry
+
         for event in events:
-            if event.type == evdev.ecodes.EV_ABS:
-                if event.code == 0:
-                    # Left stick, X axis
-                    self.LEFT_AXIS_X = self._recalc_axis(event.value)
-                elif event.code == 1:
-                    # Left stick, Y axis
-                    self.LEFT_AXIS_Y = self._recalc_axis(event.value)
-                elif event.code == 2:
-                    # Right stick, X axis
-                    self.RIGHT_AXIS_X = self._recalc_axis(event.value)
-                elif event.code == 5:
-                    # Right stick, Y axis (yes, 5...)
-                    self.RIGHT_AXIS_Y = self._recalc_axis(event.value)
-            elif event.type == evdev.ecodes.EV_KEY:
-                if event.value == 1:  # Key Down
-                    if event.code == 288:
-                        self.SELECT = True
-                    elif event.code == 291:
-                        self.START = True
-                    elif event.code == 289:
-                        self.LEFT_STICK = True
-                    elif event.code == 290:
-                        self.RIGHT_STICK = True
-                    elif event.code == 295:
-                        self.LEFT = True
-                    elif event.code == 292:
-                        self.UP = True
-                    elif event.code == 293:
-                        self.RIGHT = True
-                    elif event.code == 294:
-                        self.DOWN = True
-                    elif event.code == 704:
-                        self.PS = True
-                    elif event.code == 303:
-                        self.SQUARE = True
-                    elif event.code == 300:
-                        self.TRIANGLE = True
-                    elif event.code == 301:
-                        self.CIRCLE = True
-                    elif event.code == 302:
-                        self.CROSS = True
-                    elif event.code == 299:
-                        self.R1 = True
-                    elif event.code == 297:
-                        self.R2 = True
-                    elif event.code == 298:
-                        self.L1 = True
-                    elif event.code == 296:
-                        self.L2 = True
-                elif event.value == 2:  # Key hold
-                    pass
-                elif event.value == 0:  # Key UP
-                    if event.code == 288:
-                        self.SELECT = False
-                    elif event.code == 291:
-                        self.START = False
-                    elif event.code == 289:
-                        self.LEFT_STICK = False
-                    elif event.code == 290:
-                        self.RIGHT_STICK = False
-                    elif event.code == 295:
-                        self.LEFT = False
-                    elif event.code == 292:
-                        self.UP = False
-                    elif event.code == 293:
-                        self.RIGHT = False
-                    elif event.code == 294:
-                        self.DOWN = False
-                    elif event.code == 704:
-                        self.PS = False
-                    elif event.code == 303:
-                        self.SQUARE = False
-                    elif event.code == 300:
-                        self.TRIANGLE = False
-                    elif event.code == 301:
-                        self.CIRCLE = False
-                    elif event.code == 302:
-                        self.CROSS = False
-                    elif event.code == 299:
-                        self.R1 = False
-                    elif event.code == 297:
-                        self.R2 = False
-                    elif event.code == 298:
-                        self.L1 = False
-                    elif event.code == 296:
-                        self.L2 = False
+            if telemetry:
+                telemetry.record(CONTROLLER, event.code, event.type, event.value)
+            if event.type == evdev.ecodes.EV_KEY:
+                slot = button_slots.get(event.code)
+                if slot is None:
+                    continue
+                if event.value == 2:  # Key hold
+                    self._pending_holds.add(slot)
+                else:
+                    pending_buttons[slot] = event.value == 1
+            elif event.type == evdev.ecodes.EV_ABS:
+                axis = axes.get(event.code)
+                if axis is not None:
+                    slot, minimum, last, table = axis
+                    pending_axes[slot] = table[min(max(event.value - minimum, 0), last)]
+                elif event.code in hat_slots:
+                    negative, positive = hat_slots[event.code]
+                    pending_buttons[negative] = event.value < 0
+                    pending_buttons[positive] = event.value > 0
+            elif event.type == evdev.ecodes.EV_SYN:
+                if event.code == evdev.ecodes.SYN_REPORT:
+                    self._commit()
+                elif event.code == evdev.ecodes.SYN_DROPPED:
+                    self._resync()
+
+    def _commit(self):
+        """ Apply the changes of one report to the state
+
+        Callbacks are only dispatched for buttons that actually changed
+        """
+        for slot, pressed in self._pending_buttons.items():
+            if self.buttons[slot] != pressed:
+                self.buttons[slot] = pressed
+                self._button_changed(slot, pressed)
+        for slot in self._pending_holds:
+            if self.buttons[slot]:
+                for callback in self._hold_callbacks.get(slot, ()):
+                    self._dispatch(callback)
+        for slot, value in self._pending_axes.items():
+            self.axes[slot] = value
+        self._pending_buttons.clear()
+        self._pending_axes.clear()
+        self._pending_holds.clear()
+
+    def _resync(self):
+        """ Events were dropped by the kernel, rebuild the button state """
+        self._pending_buttons.clear()
+        self._pending_axes.clear()
+        self._pending_holds.clear()
+        active = set(self.device.active_keys())
+        for code, slot in self.mapping.button_slots.items():
+            self._pending_buttons[slot] = code in active
 
 if __name__ == '__main__':
     controller = RemoteControl()
     loop = asyncio.get_event_loop()
+    loop.run_until_complete(controller.start())
     while not controller.START:
         future = asyncio.ensure_future(controller.handle_events())
         loop.run_until_complete(future)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+""" Deterministic replay of recorded runs
+
+Feeds the sonar readings and controller events of a telemetry
+recording back into Robot on a virtual clock, as fast as the CPU
+allows, and checks the motor commands it produces against the
+recording or a golden file.
+"""
+
+import argparse
+import asyncio
+import evdev
+from robot import Robot, CONTROL_RATE
+from ps3_controller import RemoteControl
+from simulation import (VirtualClockLoop, SimulatedBoard, ScriptedInputDevice, SimulatedAudio,
+                        InlineExecutor, press)
+from telemetry import (load_telemetry, SONAR, CONTROLLER, MOTOR, STATE,
+                       STATE_DRIVING_MODE, STATE_SEED, STATES)
+
+# Global Definitions
+TIME_TOLERANCE = 1 / CONTROL_RATE  # A command may be one control cycle late or early
+
+
+class ReplayMismatch(AssertionError):
+    """ The replayed motor commands differ from the expected ones """
+
+
+class Recording:
+    """ The inputs and motor commands of a recorded run
+
+    All times are in seconds from the first record.
+    """
+
+    def __init__(self, records):
+        """ Split telemetry records into the parts needed for a replay
+
+        :param records: structured array from telemetry.load_telemetry
+        """
+        if not len(records):
+            raise ValueError('The recording is empty')
+
+        start = records['time'][0]
+        self.seed = None
+        self.drive_autonomous = False
+        self.sonar_readings = []  # (time, trigger pin, distance)
+        self.script = []  # ScriptedInputDevice entries, one per report
+        self.motor_commands = []  # (time, pin, value, digital 0 / PWM 1)
+
+        report = []
+        for record in records:
+            time = float(record['time'] - start)
+            kind, code = int(record['kind']), int(record['code'])
+            if kind == SONAR:
+                self.sonar_readings.append((time, code, int(record['value0'])))
+            elif kind == MOTOR:
+                self.motor_commands.append((time, code, int(record['value0']), int(record['value1'])))
+            elif kind == CONTROLLER:
+                event_type = int(record['value0'])
+                if event_type == evdev.ecodes.EV_SYN and code == evdev.ecodes.SYN_REPORT:
+                    self.script.append((time, report))
+                    report = []
+                else:
+                    report.append((event_type, code, int(record['value1'])))
+            elif kind == STATE and code == STATE_SEED and self.seed is None:
+                self.seed = int(record['value0'])
+            elif kind == STATE and code == STATE_DRIVING_MODE and not self.script:
+                # The mode the run started in
+                self.drive_autonomous = int(record['value0']) == STATES['autonomous']
+
+        self.duration = float(records['time'][-1] - start)
+
+    @classmethod
+    def load(cls, path):
+        """ Load a recording from a telemetry file """
+        return cls(load_telemetry(path))
+
+
+class CommandRecorder:
+    """ Collects the motor commands of a replay
+
+    Takes the place of a TelemetryRecorder, everything but the motor
+    commands is ignored.
+    """
+
+    def __init__(self):
+        self.clock = None
+        self.start = None
+        self.motor_commands = []
+
+    def record(self, kind, code, value0=0, value1=0, value2=0, value3=0):
+        if kind == MOTOR:
+            self.motor_commands.append((self.clock() - self.start, code, value0, value1))
+
+    def record_state(self, subsystem, state):
+        pass
+
+    def flush(self):
+        pass
+
+
+class ReplayBoard(SimulatedBoard):
+    """ Board that plays recorded sonar readings instead of a world """
+
+    def __init__(self, loop, sonar_readings):
+        """ Initialise the replay board
+
+        :param loop: The asyncio loop
+        :param sonar_readings: list of (time, trigger pin, distance)
+        """
+        super().__init__(loop)
+        self.sonar_readings = sonar_readings
+
+    async def sonar_config(self, trigger_pin, echo_pin, cb=None, ping_interval=50,
+                           max_distance=200, cb_type=None):
+        self._record('sonar_config', trigger_pin, ping_interval)
+        self.sonars[trigger_pin] = [cb, max_distance, None]
+        if self._sonar_task is None:
+            self._sonar_task = self.loop.create_task(self._play_sonar())
+
+    async def _play_sonar(self):
+        start = self.loop.time()
+        for time, trigger_pin, distance in self.sonar_readings:
+            delay = start + time - self.loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            callback = self.sonars.get(trigger_pin, [None])[0]
+            if callback:
+                await callback([trigger_pin, distance])
+
+
+def replay(recording, control_rate=CONTROL_RATE):
+    """ Run a recording through Robot on a virtual clock
+
+    :param recording: the Recording to replay
+    :param control_rate: the control rate the recording was made with
+    :returns: list of (time, pin, value, digital 0 / PWM 1) motor commands
+    """
+    loop = VirtualClockLoop()
+    asyncio.set_event_loop(loop)
+
+    # Runs that crashed never saw <START>, end those one control cycle
+    # after the last record. Otherwise this press is never read
+    script = recording.script + [press(recording.duration + 1 / control_rate, 'START')]
+
+    commands = CommandRecorder()
+    board = ReplayBoard(loop, recording.sonar_readings)
+    controller = RemoteControl(loop=loop, device=ScriptedInputDevice(script, loop))
+    robot = Robot(recording.drive_autonomous, loop, control_rate, board=board, controller=controller,
+                  audio=SimulatedAudio(loop), telemetry=commands, seed=recording.seed,
+                  plan_executor=InlineExecutor())
+    commands.start = loop.time()
+    robot.run()
+    loop.run_until_complete(board.shutdown())
+    loop.close()
+    return commands.motor_commands
+
+
+def compare_commands(expected, actual, tolerance=TIME_TOLERANCE):
+    """ Raise ReplayMismatch when two motor command streams differ
+
+    The pins, values and order have to match exactly, the times
+    within tolerance seconds.
+    """
+    # Leave room for the rounding of the clock
+    tolerance += 1e-9
+    for index, (want, got) in enumerate(zip(expected, actual)):
+        if want[1:] != got[1:] or abs(want[0] - got[0]) > tolerance:
+            raise ReplayMismatch('Motor command {} differs: expected {}, got {}'.format(index, want, got))
+    if len(expected) != len(actual):
+        raise ReplayMismatch('Expected {} motor commands, got {}'.format(len(expected), len(actual)))
+
+
+def write_golden(path, commands):
+    """ Write a motor command stream to a golden file """
+    with open(path, 'w') as golden:
+        for time, pin, value, mode in commands:
+            golden.write('{:.6f} {} {} {}\n'.format(time, pin, value, mode))
+
+
+def read_golden(path):
+    """ Read a motor command stream from a golden file """
+    commands = []
+    with open(path) as golden:
+        for line in golden:
+            time, pin, value, mode = line.split()
+            commands.append((float(time), int(pin), int(value), int(mode)))
+    return commands
+
+
+if __name__ == '__main__':
+    import contextlib
+    import io
+    import time
+
+    parser = argparse.ArgumentParser(description='Replay a telemetry recording through Robot')
+    parser.add_argument('recording', help='telemetry file to replay')
+    parser.add_argument('--golden', help='compare against this golden file instead of the recording')
+    parser.add_argument('--write-golden', help='write the replayed motor commands to this file')
+    parser.add_argument('--control-rate', type=float, default=CONTROL_RATE)
+    args = parser.parse_args()
+
+    recording = Recording.load(args.recording)
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        commands = replay(recording, args.control_rate)
+    elapsed = time.perf_counter() - started
+    print('Replayed {:.1f} s of driving in {:.2f} s'.format(recording.duration, elapsed))
+
+    if args.write_golden:
+        write_golden(args.write_golden, commands)
+    if args.golden:
+        compare_commands(read_golden(args.golden), commands, tolerance=1e-6)
+    else:
+        compare_commands(recording.motor_commands, commands, 1 / args.control_rate)
+    print('{} motor commands match'.format(len(commands)))
@@ -1,167 +1,314 @@
 #!/usr/bin/env python3
 
 import asyncio
-import time
+import importlib
 import random
+import time
+import logger
+import metrics
 from ps3_controller import RemoteControl
-from pymata_aio.pymata3 import PyMata3
-from pymata_aio.constants import Constants
+from pymata_aio.pymata_core import PymataCore
 from sonar import Sonar
-from dc_motors import DcMotors
+from dc_motors import DcMotors, sides
 from audio import Audio
+from scheduler import FixedRateScheduler
+from analog_drive import AnalogDrive
+from autonomous import AutonomousDriving, IDLE
+from stream import StreamServer, STREAM_HOST
+from telemetry import STATE, STATE_DRIVING_MODE, STATE_SEED
 
 # Global Definitions
-MIN_DISTANCE = 20  # Distance to start avoiding
-MAX_TURN_ATTEMPTS = 3  # The amount of tries to turn until going in reverse
+CONTROL_RATE = 50  # Control loop cycles per second
+
+log = logger.get('robot')
 
 
 class Robot:
 
-    def __init__(self, drive_autonomous=False, loop=None):
-        """ Initialise Robot """
+    def __init__(self, drive_autonomous=False, loop=None, control_rate=CONTROL_RATE,
+                 board=None, controller=None, audio=None, telemetry=None, seed=None,
+                 metrics_port=None, plan_executor=None, stream_port=None, stream_host=STREAM_HOST):
+        """ Initialise Robot
 
-        self.board = PyMata3()
-        self.dc_motors = DcMotors(self.board)
-        self.sonar = Sonar(self.board)
-        self.controller = RemoteControl()
-        self.audio = Audio()
+        The board, controller and audio are created from the hardware
+        unless they are passed in, for example from simulation.py
 
+        :param drive_autonomous: Start in autonomous driving mode
+        :param loop: The asyncio loop to run on
+        :param control_rate: Control loop cycles per second
+        :param board: A started PymataCore or a stand-in for it
+        :param controller: A RemoteControl
+        :param audio: An Audio player
+        :param telemetry: A TelemetryRecorder to record the run to
+        :param seed: Seed for the random decisions of the autonomous
+                     driving, it is recorded so a run can be replayed
+        :param metrics_port: Turn on the latency instrumentation and serve
+                             it on http://127.0.0.1:metrics_port/metrics
+        :param plan_executor: concurrent.futures.Executor for the route
+                              planner, a pool of worker processes by default
+        :param stream_port: Stream the robot state and take drive commands
+                            on this UDP port, see stream.py
+        :param stream_host: Address the stream listens on
+        """
+        self._started = time.perf_counter()
+        # Our own board is connected by start, one passed in is ready to use
+        self._connect_board = board is None
+        if board is None:
+            board = PymataCore(arduino_wait=2, event_loop=loop)
+        self.board = board
         if loop:
             self.loop = loop
         else:
             self.loop = self.board.loop
+
+        self.dc_motors = DcMotors(self.board, self.loop)
+        self.sonar = Sonar(self.board)
+        self.controller = controller or RemoteControl(loop=self.loop)
+        self.audio = audio or Audio(self.loop)
+        self.analog_drive = AnalogDrive()
         self.drive_autonomous = drive_autonomous
+        self.scheduler = FixedRateScheduler(control_rate, self.loop)
+
+        if seed is None:
+            seed = random.getrandbits(31)
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.autonomous = AutonomousDriving(self.dc_motors, self.sonar, self.random)
+
+        self.telemetry = telemetry
+        if telemetry:
+            telemetry.clock = self.loop.time
+            self.dc_motors.telemetry = telemetry
+            self.sonar.telemetry = telemetry
+            self.controller.telemetry = telemetry
+            self.autonomous.telemetry = telemetry
+
+        self.metrics_port = metrics_port
+        if metrics_port:
+            metrics.enable()
+
+        self.stream = None
+        if stream_port is not None:
+            self.stream = StreamServer(self, self.loop, stream_host, stream_port)
+        # Whether the stream clients drove in the last control cycle
+        self._remote_driving = False
+
+        self._tasks = []
+        # Start-ups that go on in the background after start returned
+        self._background_starts = []
+        # The mapping.Mapper and planner.Planner once NumPy is loaded
+        self.mapper = None
+        self.planner = None
+        self._plan_executor = plan_executor
+        # Subsystem: seconds from the start of Robot until it was ready
+        self.startup_times = {'init': time.perf_counter() - self._started}
+
+        self.controller.on_connect(self._controller_connected)
+        self.controller.on_disconnect(self._controller_lost)
+        self.controller.on_press('SELECT', self._toggle_driving_mode)
+        self.controller.on_press('CROSS', self._play_music)
 
     def run(self):
         """ This is the main running loop
 
-        This will handle time based action like starting, stopping
-        and turning for x amount of time when an obstacle is detected
+        Runs the controller input, sonar, control loop and motor
+        output as separate asyncio tasks until <START> is pressed
+        """
+        logger.start()
+        log.info('Starting main loop')
+        try:
+            self.loop.run_until_complete(self._run_tasks())
+        finally:
+            # Everything is on the console before run returns
+            logger.stop()
+
+    async def start(self):
+        """ Start the subsystems
+
+        Subsystems that don't depend on each other start at the same
+        time. Opening the controller and decoding the sound cues run in
+        the default executor, so they go on while the board handshake
+        blocks the loop. Returns as soon as the board and controller
+        are ready, the sound cues and the map may still be loading.
+
+        The time each subsystem was ready is kept in startup_times.
+        Executor jobs that finish during the handshake are only seen
+        as ready when it is done.
+        """
+        # The executor jobs have to be submitted before the board handshake starts
+        self._background_starts = [asyncio.ensure_future(self._timed_start('audio', self.audio.start())),
+                                   asyncio.ensure_future(self._timed_start('mapping', self._start_mapping()))]
+        await asyncio.gather(self._timed_start('controller', self.controller.start()),
+                             self._timed_start('board', self._start_board_subsystems()))
+        self.startup_times['ready'] = time.perf_counter() - self._started
+        log.info('Start-up: %s', self.startup_report())
+
+    async def _start_board_subsystems(self):
+        """ Connect to the board and configure the motor and sonar pins """
+        if self._connect_board:
+            await self.board.start_aio()
+        await asyncio.gather(self.dc_motors.start(), self.sonar.start())
+
+    async def _start_mapping(self):
+        """ Import NumPy in the default executor and start the occupancy grid """
+        mapping = await self.loop.run_in_executor(None, importlib.import_module, 'mapping')
+        self.mapper = mapping.Mapper(self.dc_motors, self.sonar, self.loop.time)
+        self.autonomous.mapper = self.mapper
+        self._background_starts.append(asyncio.ensure_future(self._timed_start('planner', self._start_planner())))
+
+    async def _start_planner(self):
+        """ Start the route planner workers and request plans while driving autonomously """
+        planner = await self.loop.run_in_executor(None, importlib.import_module, 'planner')
+        self.planner = planner.Planner(self.mapper.grid, self.loop, executor=self._plan_executor)
+        await self.planner.start()
+        self.autonomous.planner = self.planner
+        self._tasks.append(asyncio.ensure_future(
+            self.planner.run(lambda: self.mapper.dead_reckoning.pose, lambda: self.autonomous.state != IDLE)))
+
+    async def _timed_start(self, name, start):
+        """ Await a start coroutine and record when it was done in startup_times """
+        await start
+        self.startup_times[name] = time.perf_counter() - self._started
+
+    def startup_report(self):
+        """ Returns the start-up timing breakdown as text """
+        return ', '.join('%s %.3f s' % (name, seconds) for name, seconds
+                         in sorted(self.startup_times.items(), key=lambda item: item[1]))
+
+    async def _run_tasks(self):
+        """ Start all subsystem tasks and wait for the controller to quit """
+        await self.start()
+
+        if self.telemetry:
+            self.telemetry.record(STATE, STATE_SEED, self.seed)
+            self.telemetry.record_state(STATE_DRIVING_MODE,
+                                        'autonomous' if self.drive_autonomous else 'manual')
+
+        if self.metrics_port:
+            metrics_server = await metrics.start_server(port=self.metrics_port)
+        if self.stream:
+            await self.stream.start()
+            self._tasks.append(asyncio.ensure_future(self.stream.run()))
+
+        controller_task = asyncio.ensure_future(self.controller.run())
+        self._tasks += [controller_task,
+                        asyncio.ensure_future(self.sonar.run()),
+                        asyncio.ensure_future(self.dc_motors.run()),
+                        asyncio.ensure_future(self.scheduler.run(self._control_tick))]
+        try:
+            await controller_task
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self.dc_motors.stop(ramp=False)
+            await self.dc_motors.flush()
+            for start in self._background_starts:
+                start.cancel()
+            await self.audio.shutdown()
+            if self.planner:
+                self.planner.close()
+                log.info('Planner: %s', self.planner)
+            if self.telemetry:
+                self.telemetry.flush()
+            if self.metrics_port:
+                metrics_server.close()
+            if self.stream:
+                self.stream.close()
+                log.info('Stream: %s', self.stream)
+            log.info('Sonar: %s', self.sonar)
+            log.info('Control loop: %s', self.scheduler)
+            log.info('Logging: %s', logger.stats())
+
+    def _control_tick(self):
+        """ Handles one cycle of the control loop
+
+        Only manual driving runs per cycle, autonomous driving reacts
+        to the sonar and motor events directly (see autonomous.py).
+        Fresh drive commands from the stream take precedence over the
+        controller, the motors stop when they run out.
+        """
+        if metrics.ENABLED:
+            started = metrics.clock()
+        if not self.drive_autonomous:
+            remote = self.stream is not None and self.stream.drive.connected
+            if remote:
+                self._manual_control(self.stream.drive)
+            elif self._remote_driving:
+                self.analog_drive.reset()
+                self.dc_motors.stop()
+            elif self.controller.connected:
+                self._manual_control(self.controller)
+            self._remote_driving = remote
+        if metrics.ENABLED:
+            metrics.DECISION.observe_since(started)
+
+    def _controller_connected(self):
+        """ Resume driving in the current mode """
+        if self.drive_autonomous and self.autonomous.state == IDLE:
+            self.autonomous.start()
+
+    def _controller_lost(self):
+        """ Failsafe, stop while nobody is able to take over """
+        log.warning('Controller lost, stopping the motors until it is back')
+        self.autonomous.stop()
+        self.analog_drive.reset()
+        self.dc_motors.stop()
+
+    def _toggle_driving_mode(self):
+        """ Switch between remote controlled and autonomous driving """
+        if self.drive_autonomous:
+            log.info('Switching to remote controlled driving')
+            self.drive_autonomous = False
+            self.autonomous.stop()
+            self.analog_drive.reset()
+        else:
+            log.info('Switching to autonomous driving')
+            self.drive_autonomous = True
+            self.autonomous.start()
+
+        if self.telemetry:
+            self.telemetry.record_state(STATE_DRIVING_MODE,
+                                        'autonomous' if self.drive_autonomous else 'manual')
+
+    def _play_music(self):
+        """ Start the music baby """
+        self.audio.play('hello_son')
+
+    def _manual_control(self, controls):
+        """ Handles one loop cycle of manual driving
+
+        The D-pad drives at full speed. When it is released the left
+        stick drives proportionally, only changed speeds are sent
+        to the motors.
+
+        :param controls: The RemoteControl, or the stream.RemoteDrive
         """
+        if not (controls.UP or controls.DOWN or
+                controls.LEFT or controls.RIGHT):
+            speeds = self.analog_drive.update(controls.LEFT_AXIS_X,
+                                              controls.LEFT_AXIS_Y)
+            if speeds is not None:
+                self.dc_motors.set_wheels(sides(*speeds))
+            return
 
-        music_playing = False
-        turn_attempts = 0
-
-        print('Starting main loop')
-        while not self.controller.START:
-            future = asyncio.ensure_future(self.controller.handle_events())
-            self.loop.run_until_complete(future)
-
-            # Switch driving mode
-            if self.controller.SELECT:
-                if self.drive_autonomous:
-                    print('Switching to remote controlled driving')
-                    self.drive_autonomous = False
-                else:
-                    print('Switching to autonomous driving')
-                    self.drive_autonomous = True
-                    turn_attempts = 0
-                    self.dc_motors.forward(100)
-            
-            if self.controller.CROSS and not music_playing:
-                # Start the music baby
-                self.loop.run_until_complete(self.audio.play_audio('static/audio/hello_son.mp3'))
-                music_playing = True
-    
-            if self.drive_autonomous:
-                self._detect_obstacles(turn_attempts)
-            else:
-                self._manual_control()
-
-    def _manual_control(self):
-        """ Handles one loop cycle of manual driving """
-        if self.controller.UP and self.controller.LEFT:
-            self.dc_motors.up_left(255)
-        elif self.controller.UP and self.controller.RIGHT:
-            self.dc_motors.up_right(255)
-        elif self.controller.DOWN and self.controller.LEFT:
-            self.dc_motors.down_left(255)
-        elif self.controller.DOWN and self.controller.RIGHT:
-            self.dc_motors.down_right(255)
-        elif self.controller.UP:
-            self.dc_motors.forward(255)
-        elif self.controller.DOWN:
-            self.dc_motors.reverse(255)
-        elif self.controller.LEFT:
-            self.dc_motors.left(255)
-        elif self.controller.RIGHT:
-            self.dc_motors.right(255)
+        self.analog_drive.reset()
+        direction = 1 if controls.UP else -1 if controls.DOWN else 0
+        turn = 1 if controls.LEFT else -1 if controls.RIGHT else 0
+        if not direction:
+            # Spin on the spot
+            self.dc_motors.set_wheels(sides(-turn * 255, turn * 255))
         else:
-            self.dc_motors.stop()
-
-    def _detect_obstacles(self, turn_attempts):
-        """ Handles one loop cycle of autonomous driving """
-        current_time = time.time()
-        distance = self.sonar.distance
-        print('Distance: %s' % distance)
-
-        # Getting to close, lets try to turn
-        if distance < MIN_DISTANCE and not self.dc_motors.state.startswith('turning'):
-            turn_attempts += 1
-            random_value = random.randint(1, 2)
-            if random_value == 1:
-                print('Getting too close, turning left for 2 seconds!')
-                self.dc_motors.left(255, 3)
-            elif random_value == 2:
-                self.dc_motors.right(255, 3)
-                print('Getting too close, turning right for 2 seconds!')
-
-        # Turning doesnt seem to work, lets go in reverse
-        elif turn_attempts > MAX_TURN_ATTEMPTS:
-            self.dc_motors.reverse(100, 3)
-            turn_attempts = 0
-
-        # Handle finished motor actions
-        elif self.dc_motors.action_time_duration:
-            action_end_time = self.dc_motors.action_time_start + self.dc_motors.action_time_duration
-
-            print('start: {}\nduration: {}\nend: {}\ncurrent: {}'
-                  .format(self.dc_motors.action_time_start,
-                          self.dc_motors.action_time_duration,
-                          action_end_time,
-                          current_time))
-
-            # TODO: I DONT GET THIS AT ALL!! THIS SHOULD READ
-            # if action_end_time >= current_time:
-            # BUT THEN IT DOESNT WORK. QUESS IM UP TOO LONG TO SEE IT
-            if action_end_time <= current_time:
-                # Check if the obstacle is cleared
-                if self.dc_motors.state.startswith('turning'):
-                    if distance < MIN_DISTANCE:
-                        print("%s for 2 seconds wasn't enough. Lets do another 2 sec" % self.dc_motors.state)
-                        if self.dc_motors.state.endswith('left'):
-                            self.dc_motors.left(255, 2)
-                        else:
-                            self.dc_motors.right(255, 2)
-                        turn_attempts += 1
-                    else:
-                        print('Ok, obstacle cleared, moving forward...')
-                        self.dc_motors.forward(100)
-                        turn_attempts = 0
-
-                # Reverse action completed, lets turn around
-                elif self.dc_motors.state == 'reverse':
-                    # TODO: Deduplicate random turn code
-                    turn_attempts += 1
-                    random_value = random.randint(1, 2)
-                    if random_value == 1:
-                        print('Finished reversing, turning left for 2 sec')
-                        self.dc_motors.left(255, 2)
-                    elif random_value == 2:
-                        self.dc_motors.right(255, 2)
-                        print('Finished reversing, turning right for 2 sec')
-
-        # run for a bit before re-iterating through the loop again
-        self.board.sleep(0.2)
+            # A soft turn slows down the inner side to a quarter
+            inner = direction * (255 // 4)
+            left = inner if turn > 0 else direction * 255
+            right = inner if turn < 0 else direction * 255
+            self.dc_motors.set_wheels(sides(left, right))
 
     def shutdown(self):
         """ Shutdown robot """
-        self.board.shutdown()
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(asyncio.sleep(.1))
-        for t in asyncio.Task.all_tasks(loop):
-            t.cancel()
-        loop.run_until_complete(asyncio.sleep(.1))
-        loop.stop()
-        loop.close()
-        sys.exit(0)
+        for task in self._tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.sleep(.1))
+        self.loop.run_until_complete(self.board.shutdown())
+        logger.stop()
@@ -1,9 +1,23 @@
 #!/usr/bin/env python3
 
+import os
+import logger
 from robot import Robot
+from telemetry import TelemetryRecorder
+
+TELEMETRY_FILE = 'telemetry.bin'
 
 if __name__ == "__main__":
-    robot = Robot()
+    # Set METRICS_PORT to serve latency metrics, e.g. METRICS_PORT=9105
+    metrics_port = int(os.environ.get('METRICS_PORT', 0)) or None
+    # Set STREAM_PORT to stream the robot state over UDP, e.g. STREAM_PORT=9106
+    # STREAM_HOST=0.0.0.0 to watch and drive from another machine, see stream.py
+    stream_port = int(os.environ.get('STREAM_PORT', 0)) or None
+    stream_args = {'stream_host': os.environ['STREAM_HOST']} if 'STREAM_HOST' in os.environ else {}
+    # Set LOG_LEVEL to change the log levels, e.g. LOG_LEVEL=info,autonomous=debug
+    logger.configure(os.environ.get('LOG_LEVEL', ''))
+    robot = Robot(telemetry=TelemetryRecorder(TELEMETRY_FILE), metrics_port=metrics_port,
+                  stream_port=stream_port, **stream_args)
 
     print('Robot initialised, remote controlled. press <SELECT> to toggle autonomous driving')
     try:
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+import asyncio
+import math
+
+
+class FixedRateScheduler:
+    """ Runs a callback at a fixed rate
+
+    Deadlines are absolute times on the monotonic clock of the event
+    loop. The time spent in the callback is subtracted from the sleep
+    so the loop period does not drift with the work done in a cycle.
+    A cycle that overruns its deadline counts as a missed deadline and
+    the schedule skips ahead instead of trying to catch up in a burst.
+    """
+
+    def __init__(self, rate=50, loop=None):
+        """ Initialise the scheduler
+
+        :param rate: Number of cycles per second, 50-200 Hz is sensible
+        :param loop: The asyncio loop to take the time from
+        """
+        if rate <= 0:
+            raise ValueError('rate should be larger than zero')
+
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.loop = loop or asyncio.get_event_loop()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """ Clear the timing statistics """
+        self.cycles = 0
+        self.missed_deadlines = 0
+        self.max_lateness = 0.0
+        self.min_period = None
+        self.max_period = None
+        self._last_start = None
+        self._period_mean = 0.0
+        self._period_m2 = 0.0
+
+    async def run(self, callback):
+        """ Call callback once every period until cancelled
+
+        :param callback: Function called without arguments each cycle
+        """
+        deadline = self.loop.time()
+        while True:
+            start = self.loop.time()
+            self._record(start, deadline)
+
+            callback()
+
+            deadline += self.period
+            now = self.loop.time()
+            if now > deadline:
+                missed = int((now - deadline) / self.period) + 1
+                self.missed_deadlines += missed
+                deadline += missed * self.period
+            await asyncio.sleep(deadline - now)
+
+    def _record(self, start, deadline):
+        """ Update the statistics with the start time of a cycle
+
+        :param start: The time the cycle actually started
+        :param deadline: The time the cycle should have started
+        """
+        self.cycles += 1
+        self.max_lateness = max(self.max_lateness, start - deadline)
+
+        if self._last_start is not None:
+            period = start - self._last_start
+            if self.min_period is None or period < self.min_period:
+                self.min_period = period
+            if self.max_period is None or period > self.max_period:
+                self.max_period = period
+
+            # Welford's running mean and variance of the period
+            count = self.cycles - 1
+            delta = period - self._period_mean
+            self._period_mean += delta / count
+            self._period_m2 += delta * (period - self._period_mean)
+        self._last_start = start
+
+    @property
+    def jitter(self):
+        """ Standard deviation of the measured period in seconds """
+        if self.cycles < 3:
+            return 0.0
+        return math.sqrt(self._period_m2 / (self.cycles - 2))
+
+    def stats(self):
+        """ Returns a dictionary with the timing statistics """
+        return {'rate': self.rate,
+                'cycles': self.cycles,
+                'period_target': self.period,
+                'period_mean': self._period_mean,
+                'period_min': self.min_period,
+                'period_max': self.max_period,
+                'jitter': self.jitter,
+                'max_lateness': self.max_lateness,
+                'missed_deadlines': self.missed_deadlines}
+
+    def __str__(self):
+        return ('{} cycles at {} Hz, period {:.2f} ms (target {:.2f} ms), '
+                'jitter {:.3f} ms, max lateness {:.2f} ms, {} missed deadlines'
+                .format(self.cycles, self.rate,
+                        self._period_mean * 1000, self.period * 1000,
+                        self.jitter * 1000, self.max_lateness * 1000,
+                        self.missed_deadlines))
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    scheduler = FixedRateScheduler(100, loop)
+    task = asyncio.ensure_future(scheduler.run(lambda: None))
+    loop.run_until_complete(asyncio.sleep(2))
+    task.cancel()
+    print(scheduler)
@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+
+""" Hardware-free stand-ins for the Arduino, controller and audio
+
+Run the whole Robot control loop headless, faster than real time:
+
+    robot = simulate([press(1, 'SELECT'), release(1.1, 'SELECT')], duration=60)
+    print(robot.board.log)
+"""
+
+import asyncio
+import concurrent.futures
+import math
+import selectors
+from collections import deque, namedtuple
+import evdev
+from pymata_aio.private_constants import PrivateConstants
+from dc_motors import (MOTOR_FRONT_LEFT_PIN1, MOTOR_FRONT_LEFT_PIN2, MOTOR_FRONT_LEFT_ENABLE_PIN,
+                       MOTOR_REAR_LEFT_PIN1, MOTOR_REAR_LEFT_PIN2, MOTOR_REAR_LEFT_ENABLE_PIN,
+                       MOTOR_REAR_RIGHT_PIN1, MOTOR_REAR_RIGHT_PIN2, MOTOR_REAR_RIGHT_ENABLE_PIN,
+                       MOTOR_FRONT_RIGHT_PIN1, MOTOR_FRONT_RIGHT_PIN2, MOTOR_FRONT_RIGHT_ENABLE_PIN)
+from ps3_controller import RemoteControl, PS3_MAPPING, BUTTON_SLOTS, AXIS_SLOTS
+from robot import Robot
+
+# Global Definitions
+CM_PER_SECOND_PER_PWM = 0.2  # Ground speed of a wheel per unit of PWM
+TRACK_WIDTH = 15  # Distance between the left and right wheels in cm
+SONAR_CONE = math.radians(15)  # Half the opening angle of the HC-SR04 beam
+SONAR_RAYS = 5  # The number of rays cast over the beam
+
+
+class _VirtualClockSelector(selectors.BaseSelector):
+    """ Selector that moves the virtual clock instead of waiting
+
+    Ready file descriptors are still returned, but when nothing is
+    ready the clock of the loop jumps to the time the loop wanted
+    to wait for.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self.loop = None
+
+    def register(self, fileobj, events, data=None):
+        return self._selector.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self._selector.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self._selector.modify(fileobj, events, data)
+
+    def get_map(self):
+        return self._selector.get_map()
+
+    def close(self):
+        self._selector.close()
+
+    def select(self, timeout=None):
+        events = self._selector.select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            # Nothing scheduled, only real I/O can wake us up
+            return self._selector.select(None)
+        self.loop.advance(timeout)
+        return events
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """ Event loop on a virtual clock that runs as fast as the CPU allows
+
+    Sleeps and timers complete immediately, the clock is moved forward
+    to their deadline instead.
+    """
+
+    def __init__(self, start_time=0.0):
+        selector = _VirtualClockSelector()
+        super().__init__(selector)
+        selector.loop = self
+        self._virtual_time = start_time
+
+    def time(self):
+        return self._virtual_time
+
+    def advance(self, seconds):
+        """ Move the virtual clock forward """
+        self._virtual_time += seconds
+
+    def run_in_executor(self, executor, func, *args):
+        """ Run func right away instead of in a thread
+
+        A thread would finish at whatever virtual time the loop reached
+        by then, so simulated runs would not be reproducible.
+        """
+        future = self.create_future()
+        try:
+            future.set_result(func(*args))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+
+class InlineExecutor(concurrent.futures.Executor):
+    """ Executor that runs jobs right away in the calling thread
+
+    Takes the place of the process pool of the route planner, so the
+    plans of a simulated run are ready at reproducible times.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+
+class World:
+    """ A flat 2D world of straight walls, all distances in cm """
+
+    def __init__(self, walls=()):
+        """ Initialise the world
+
+        :param walls: list of ((x1, y1), (x2, y2)) line segments
+        """
+        self.walls = list(walls)
+
+    @classmethod
+    def room(cls, width, height, obstacles=()):
+        """ Returns a rectangular room with box shaped obstacles
+
+        :param width: Width of the room
+        :param height: Height of the room
+        :param obstacles: list of (x, y, width, height) boxes
+        """
+        world = cls()
+        world.add_box(0, 0, width, height)
+        for obstacle in obstacles:
+            world.add_box(*obstacle)
+        return world
+
+    def add_box(self, x, y, width, height):
+        """ Add the four walls of a box """
+        corners = [(x, y), (x + width, y), (x + width, y + height), (x, y + height)]
+        for index in range(4):
+            self.walls.append((corners[index], corners[(index + 1) % 4]))
+
+    def cast_ray(self, x, y, heading, max_distance):
+        """ Returns the distance to the nearest wall along a ray
+
+        :param x: X of the start of the ray
+        :param y: Y of the start of the ray
+        :param heading: Direction of the ray in radians
+        :param max_distance: Distance returned when no wall is hit
+        """
+        dx, dy = math.cos(heading), math.sin(heading)
+        nearest = max_distance
+        for (ax, ay), (bx, by) in self.walls:
+            ex, ey = bx - ax, by - ay
+            denominator = dx * ey - dy * ex
+            if abs(denominator) < 1e-12:
+                continue
+            px, py = ax - x, ay - y
+            distance = (px * ey - py * ex) / denominator
+            position = (px * dy - py * dx) / denominator
+            if 0 <= distance < nearest and 0 <= position <= 1:
+                nearest = distance
+        return nearest
+
+    def sonar_distance(self, x, y, heading, max_distance):
+        """ Returns what a HC-SR04 would measure, the nearest wall in its cone """
+        return min(self.cast_ray(x, y, heading + SONAR_CONE * (2 * ray / (SONAR_RAYS - 1) - 1), max_distance)
+                   for ray in range(SONAR_RAYS))
+
+
+class SimulatedBoard:
+    """ Stand-in for PymataCore
+
+    Records every set_pin_mode, digital_write, digital port message and
+    analog_write with the loop time in log. The pin values drive a differential drive model
+    of the robot in a World, and configured sonars are pinged round
+    robin against that world.
+    """
+
+    def __init__(self, loop, world=None, pose=(50.0, 50.0, 0.0), sonar_angles=None):
+        """ Initialise the simulated board
+
+        :param loop: The asyncio loop
+        :param world: The World the robot drives in
+        :param pose: Starting (x, y, heading in radians) of the robot
+        :param sonar_angles: dictionary trigger_pin: mount angle in radians,
+                             sonars face forward by default
+        """
+        self.loop = loop
+        self.world = world or World.room(400, 300)
+        self.x, self.y, self.heading = pose
+        self.sonar_angles = sonar_angles or {}
+
+        self.log = []  # (time, command, pin, value)
+        self.pin_modes = {}
+        self.pin_values = {}
+        self.sonars = {}  # trigger_pin: [callback, max_distance, last distance]
+        self.ping_interval = None
+        self._sonar_task = None
+        self._last_move = loop.time()
+        self.ports = {}  # port: value of its eight output pins
+
+    def _record(self, command, pin, value):
+        self.log.append((self.loop.time(), command, pin, value))
+
+    def start(self):
+        pass
+
+    async def start_aio(self):
+        pass
+
+    async def shutdown(self):
+        if self._sonar_task:
+            self._sonar_task.cancel()
+
+    async def sleep(self, sleep_time):
+        await asyncio.sleep(sleep_time)
+
+    async def set_pin_mode(self, pin_number, pin_state, callback=None, cb_type=None):
+        self._record('set_pin_mode', pin_number, pin_state)
+        self.pin_modes[pin_number] = pin_state
+
+    def _set_port(self, port, value):
+        self.ports[port] = value
+        for bit in range(8):
+            self.pin_values[port * 8 + bit] = (value >> bit) & 1
+
+    async def digital_write(self, pin, value):
+        # Like PymataCore, a digital write sends the state of the whole port
+        self._move()
+        port = pin // 8
+        mask = 1 << (pin % 8)
+        port_value = self.ports.get(port, 0)
+        self._set_port(port, port_value | mask if value == 1 else port_value & ~mask)
+        self._record('digital_write', pin, value)
+
+    async def _send_command(self, command):
+        # Only digital port messages are sent directly, by DcMotors
+        port = command[0] - PrivateConstants.DIGITAL_MESSAGE
+        if 0 <= port < 16:
+            self._move()
+            value = command[1] | command[2] << 7
+            self._set_port(port, value)
+            self._record('digital_port', port, value)
+
+    async def analog_write(self, pin, value):
+        self._move()
+        self.pin_values[pin] = value
+        self._record('analog_write', pin, value)
+
+    async def sonar_config(self, trigger_pin, echo_pin, cb=None, ping_interval=50,
+                           max_distance=200, cb_type=None):
+        self._record('sonar_config', trigger_pin, ping_interval)
+        self.sonars[trigger_pin] = [cb, min(max_distance, 200), None]
+        self.ping_interval = ping_interval
+        if self._sonar_task is None:
+            self._sonar_task = self.loop.create_task(self._ping_sonars())
+
+    async def _ping_sonars(self):
+        """ Ping the sonars one after another like FirmataPlus does """
+        while True:
+            for trigger_pin, entry in list(self.sonars.items()):
+                await asyncio.sleep(self.ping_interval / 1000)
+                self._move()
+                callback, max_distance, last = entry
+                heading = self.heading + self.sonar_angles.get(trigger_pin, 0.0)
+                distance = int(self.world.sonar_distance(self.x, self.y, heading, max_distance))
+                # PymataCore only calls back when the distance changed
+                if callback and distance != last:
+                    entry[2] = distance
+                    await callback([trigger_pin, distance])
+
+    def _wheel_speed(self, pin1, pin2, enable_pin):
+        """ Returns the ground speed of one wheel in cm/s """
+        direction = self.pin_values.get(pin2, 0) - self.pin_values.get(pin1, 0)
+        return direction * self.pin_values.get(enable_pin, 0) * CM_PER_SECOND_PER_PWM
+
+    def wheel_speeds(self):
+        """ Returns the (left, right) ground speed in cm/s """
+        left = (self._wheel_speed(MOTOR_FRONT_LEFT_PIN1, MOTOR_FRONT_LEFT_PIN2, MOTOR_FRONT_LEFT_ENABLE_PIN) +
+                self._wheel_speed(MOTOR_REAR_LEFT_PIN1, MOTOR_REAR_LEFT_PIN2, MOTOR_REAR_LEFT_ENABLE_PIN)) / 2
+        right = (self._wheel_speed(MOTOR_REAR_RIGHT_PIN1, MOTOR_REAR_RIGHT_PIN2, MOTOR_REAR_RIGHT_ENABLE_PIN) +
+                 self._wheel_speed(MOTOR_FRONT_RIGHT_PIN1, MOTOR_FRONT_RIGHT_PIN2, MOTOR_FRONT_RIGHT_ENABLE_PIN)) / 2
+        return left, right
+
+    def _move(self):
+        """ Move the robot along with the wheel speeds since the last move
+
+        The speeds only change on a pin write, so integrating along an
+        arc from one write to the next is exact.
+        """
+        now = self.loop.time()
+        elapsed = now - self._last_move
+        self._last_move = now
+        if elapsed <= 0:
+            return
+
+        left, right = self.wheel_speeds()
+        speed = (left + right) / 2
+        rotation = (right - left) / TRACK_WIDTH
+        if abs(rotation) < 1e-9:
+            self.x += speed * elapsed * math.cos(self.heading)
+            self.y += speed * elapsed * math.sin(self.heading)
+        else:
+            heading = self.heading + rotation * elapsed
+            radius = speed / rotation
+            self.x += radius * (math.sin(heading) - math.sin(self.heading))
+            self.y -= radius * (math.cos(heading) - math.cos(self.heading))
+            self.heading = heading
+
+
+InputEvent = namedtuple('InputEvent', ['type', 'code', 'value'])
+
+
+def _button_code(button, mapping):
+    slot = BUTTON_SLOTS[button]
+    return next(code for code, button_slot in mapping.button_slots.items() if button_slot == slot)
+
+
+def _axis_code(axis, mapping):
+    slot = AXIS_SLOTS[axis]
+    return next(code for code, axis_slot in mapping.axis_slots.items() if axis_slot == slot)
+
+
+def press(time, button, mapping=PS3_MAPPING):
+    """ Script entry that presses button at time seconds """
+    return time, [(evdev.ecodes.EV_KEY, _button_code(button, mapping), 1)]
+
+
+def release(time, button, mapping=PS3_MAPPING):
+    """ Script entry that releases button at time seconds """
+    return time, [(evdev.ecodes.EV_KEY, _button_code(button, mapping), 0)]
+
+
+def stick(time, axis, value, mapping=PS3_MAPPING):
+    """ Script entry that moves axis to the raw value at time seconds """
+    return time, [(evdev.ecodes.EV_ABS, _axis_code(axis, mapping), value)]
+
+
+class ScriptedInputDevice:
+    """ Stand-in for evdev.InputDevice that replays a script
+
+    The script is a list of (time, [(type, code, value), ...]) entries
+    with the time in seconds after the first read. Every entry is read
+    as one report, closed by a SYN_REPORT.
+    """
+
+    def __init__(self, script, loop, name='Simulated controller'):
+        self.loop = loop
+        self.name = name
+        self._script = deque(sorted(script, key=lambda entry: entry[0]))
+        self._start = None
+        self._active_keys = set()
+
+    def __str__(self):
+        return self.name
+
+    async def async_read(self):
+        if self._start is None:
+            self._start = self.loop.time()
+        if not self._script:
+            # End of the script, nothing will ever happen again
+            await self.loop.create_future()
+
+        time, events = self._script.popleft()
+        delay = self._start + time - self.loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        events = [InputEvent(*event) for event in events]
+        for event in events:
+            if event.type == evdev.ecodes.EV_KEY:
+                if event.value:
+                    self._active_keys.add(event.code)
+                else:
+                    self._active_keys.discard(event.code)
+        events.append(InputEvent(evdev.ecodes.EV_SYN, evdev.ecodes.SYN_REPORT, 0))
+        return events
+
+    def active_keys(self):
+        return sorted(self._active_keys)
+
+
+class SimulatedAudio:
+    """ Stand-in for Audio that only records what would have been played """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.played = []  # (time, cue)
+
+    async def start(self):
+        pass
+
+    def play(self, name, priority=0):
+        self.played.append((self.loop.time(), name))
+        return True
+
+    async def play_audio(self, filename, priority=0):
+        self.play(filename, priority)
+
+    async def shutdown(self):
+        pass
+
+
+def simulate(script=(), duration=60, world=None, pose=(50.0, 50.0, 0.0),
+             drive_autonomous=False, seed=0, **robot_args):
+    """ Run the Robot headless on a virtual clock
+
+    <START> is pressed at duration seconds to end the run.
+
+    :param script: controller script, see ScriptedInputDevice
+    :param duration: simulated seconds to run
+    :param world: the World to drive in
+    :param pose: starting (x, y, heading in radians) of the robot
+    :param drive_autonomous: start in autonomous driving mode
+    :param seed: seed for the random decisions of the autonomous driver
+    :returns: the Robot, its board holds the log of all pin writes
+    """
+    loop = VirtualClockLoop()
+    asyncio.set_event_loop(loop)
+
+    board = SimulatedBoard(loop, world, pose)
+    device = ScriptedInputDevice(list(script) + [press(duration, 'START')], loop)
+    controller = RemoteControl(loop=loop, device=device)
+    robot_args.setdefault('plan_executor', InlineExecutor())
+    robot = Robot(drive_autonomous, loop, board=board, controller=controller,
+                  audio=SimulatedAudio(loop), seed=seed, **robot_args)
+    robot.run()
+    loop.run_until_complete(board.shutdown())
+    return robot
+
+
+if __name__ == '__main__':
+    import contextlib
+    import io
+    import time
+
+    world = World.room(400, 300, obstacles=[(200, 100, 40, 40)])
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        robot = simulate([press(0.5, 'SELECT'), release(0.6, 'SELECT')], duration=120, world=world)
+    elapsed = time.perf_counter() - started
+
+    writes = [entry for entry in robot.board.log if entry[1] != 'set_pin_mode']
+    print('Simulated 120 s in {:.2f} s ({:.0f}x real time)'.format(elapsed, 120 / elapsed))
+    print('{} pin writes, robot ended at x={:.0f} y={:.0f} heading={:.0f} degrees'
+          .format(len(writes), robot.board.x, robot.board.y, math.degrees(robot.board.heading)))
@@ -1,22 +1,81 @@
 #!/usr/bin/env python3
 
-from utils import moving_average
-from collections import deque
+import asyncio
+import logger
+import metrics
+from filters import create_filter, DEFAULT_WINDOW_SIZE
+from telemetry import SONAR
 
 # Global Definitions
 MAX_SONAR_DISTANCE = 200 # The maximum distance the sonar sensor will read
+HYSTERESIS = 5  # cm the distance has to rise above a threshold before it is clear again
 
 # pins
 TRIGGER_PIN = 22
 ECHO_PIN = 23
 
+log = logger.get('sonar')
+
+
+class Threshold:
+    """ Trigger on the filtered distance crossing a limit
+
+    on_below is called once when the distance falls below limit,
+    on_clear once when it has risen back to limit + hysteresis. The
+    hysteresis keeps a distance hovering around the limit from
+    triggering on every reading.
+    """
+
+    def __init__(self, limit, on_below=None, on_clear=None, hysteresis=HYSTERESIS):
+        """ Initialise the threshold
+
+        :param limit: The distance in cm
+        :param on_below: function called with the distance when it falls below limit
+        :param on_clear: function called with the distance when it is clear again
+        :param hysteresis: cm above limit the distance has to rise to be clear
+        """
+        self.limit = limit
+        self.on_below = on_below
+        self.on_clear = on_clear
+        self.hysteresis = hysteresis
+        self.below = False
+        # Time of the first of the unfiltered readings below limit in a row
+        self.reading_below = None
+
+    def update(self, distance, reading=None, now=None):
+        """ Check a new distance, calls the callbacks on a crossing
+
+        :param distance: The filtered distance
+        :param reading: The unfiltered reading, to time how long the filter took
+        :param now: The time of the reading
+        :returns: True if the distance just fell below the limit
+        """
+        if reading is not None:
+            if reading >= self.limit:
+                self.reading_below = None
+            elif self.reading_below is None:
+                self.reading_below = now
+
+        if not self.below:
+            if distance < self.limit:
+                self.below = True
+                if self.on_below:
+                    self.on_below(distance)
+                return True
+        elif distance >= self.limit + self.hysteresis:
+            self.below = False
+            if self.on_clear:
+                self.on_clear(distance)
+        return False
+
 
 class Sonar:
     """ Control Sonar Distance Sensors
 
     HR-SR04 model supported """
 
-    def __init__(self, board, trigger_pin=TRIGGER_PIN, echo_pin=ECHO_PIN, ping_interval=50, max_distance=MAX_SONAR_DISTANCE):
+    def __init__(self, board, trigger_pin=TRIGGER_PIN, echo_pin=ECHO_PIN, ping_interval=50, max_distance=MAX_SONAR_DISTANCE,
+                 filter_type='moving_average', window_size=DEFAULT_WINDOW_SIZE):
         """ Initialize Sonor Sensor(s)
 
         distance measures in cm.
@@ -26,32 +85,128 @@ class Sonar:
         :param echo_pin: The echo_pin, set this to the same as trigger ping if using only one pin
         :param ping_interval: The interval of the measurement
         :param max_distance: The maximum distance in cm that the sonar will read
+        :param filter_type: The filter used to smooth the readings, see filters.FILTERS
+        :param window_size: The number of readings the filter works on
         """
+        self.board = board
         self.trigger_pin = trigger_pin
+        self.echo_pin = echo_pin
+        self.ping_interval = ping_interval
+        self.max_distance = max_distance
+
+        # The readings are passed through a streaming filter to
+        # compensate for deviations in the measurements. Initially
+        # it is filled up with the maximum distance the sensor is
+        # able to detect
+        self.filter = create_filter(filter_type, window_size, MAX_SONAR_DISTANCE)
+
+        # (reading, clock when received) from the board, waiting for the sonar task
+        self._readings = asyncio.Queue()
+
+        # Loop time and unfiltered distance of the last reading and
+        # the functions to call with this sonar after every reading
+        self.updated = None
+        self.reading = None
+        self._listeners = []
+        self._thresholds = []
+
+        # Optional TelemetryRecorder for the raw readings
+        self.telemetry = None
 
-        # The sensor data will capture the last three measurements
-        # We will use a moving_average to compensate for deviations
-        # in the measurements. Initially will fill it up with the
-        # maximum distance the sensor is able to detect
-        # TODO: Document this somewhere more appropriately
-        self._sensor_data = deque([MAX_SONAR_DISTANCE, MAX_SONAR_DISTANCE, MAX_SONAR_DISTANCE], maxlen=3)
+        # Readings received, threshold crossings and their latency: the
+        # time from the ping before the first reading below the limit
+        # until the filtered distance crossed it
+        self.readings = 0
+        self.detections = 0
+        self.detection_latency_total = 0.0
+        self.detection_latency_max = 0.0
 
-        board.sonar_config(trigger_pin=trigger_pin,
-                           echo_pin=echo_pin,
-                           cb=self.cb_got_data, cb_type=1,
-                           ping_interval=ping_interval,
-                           max_distance=max_distance)
+    async def start(self):
+        """ Configure the sonar on the board """
+        await self.board.sonar_config(trigger_pin=self.trigger_pin,
+                                      echo_pin=self.echo_pin,
+                                      cb=self.cb_got_data, cb_type=1,
+                                      ping_interval=self.ping_interval,
+                                      max_distance=self.max_distance)
+
+    async def run(self):
+        """ Sonar consumption task
+
+        Takes the readings handed over by cb_got_data and updates
+        the filter, so reading distance is only a lookup
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            reading, received = await self._readings.get()
+            self.filter.update(reading)
+            if received:
+                metrics.SONAR_CONSUME.observe_since(received)
+            now = self.updated = loop.time()
+            self.reading = reading
+            self.readings += 1
+            distance = self.filter.value
+            log.debug('Distance: %s, reading %s', distance, reading)
+            for threshold in self._thresholds:
+                if threshold.update(distance, reading, now) and threshold.reading_below is not None:
+                    self._detected(now - threshold.reading_below + self.ping_interval / 1000)
+            for listener in self._listeners:
+                listener(self)
+
+    def _detected(self, latency):
+        """ Count a threshold crossing and its latency in seconds """
+        self.detections += 1
+        self.detection_latency_total += latency
+        self.detection_latency_max = max(self.detection_latency_max, latency)
+        if metrics.ENABLED:
+            metrics.SONAR_DETECTION.observe(latency)
+
+    def add_listener(self, listener):
+        """ Call listener(sonar) after every new reading
+
+        :param listener: function taking this sonar as only argument
+        """
+        self._listeners.append(listener)
+
+    def add_threshold(self, limit, on_below=None, on_clear=None, hysteresis=HYSTERESIS):
+        """ Get notified when the filtered distance crosses limit
+
+        The threshold is checked for every reading, so an obstacle is
+        reported within one ping interval of the filter seeing it.
+
+        :param limit: The distance in cm
+        :param on_below: function called with the distance when it falls below limit
+        :param on_clear: function called with the distance when it has risen
+                         to limit + hysteresis again
+        :param hysteresis: cm above limit the distance has to rise to be clear
+        :returns: the Threshold, pass it to remove_threshold to stop the notifications
+        """
+        threshold = Threshold(limit, on_below, on_clear, hysteresis)
+        # Start out in the right state, without calling on_below
+        threshold.below = self.distance < limit
+        self._thresholds.append(threshold)
+        return threshold
+
+    def remove_threshold(self, threshold):
+        """ Stop the notifications of a threshold from add_threshold """
+        self._thresholds.remove(threshold)
 
     @property
     def distance(self):
-        """ Returns the moving average of the _sensor_data """
-        return moving_average(list(self._sensor_data), 3)
+        """ Returns the filtered distance """
+        return self.filter.value
+
+    def __str__(self):
+        mean = self.detection_latency_total / self.detections if self.detections else 0.0
+        return '%d readings, %d detections, detection latency mean %.0f ms, max %.0f ms' % (
+            self.readings, self.detections, mean * 1000, self.detection_latency_max * 1000)
 
     async def cb_got_data(self, data):
         """ Callback when there is data available
 
         :param data: list containing [trigger_pin, distance in cm]
-        adds the received data to the _sensor_data list
+        hands the received distance over to the sonar task
         """
-        # print("Async Sensor Data {}".format(data[1]))
-        self._sensor_data.append(data[1])
+        if self.telemetry:
+            self.telemetry.record(SONAR, data[0], data[1])
+        self._readings.put_nowait((data[1], metrics.clock() if metrics.ENABLED else None))
+
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import asyncio
+from collections import namedtuple
+import logger
+from filters import DEFAULT_WINDOW_SIZE
+from sonar import Sonar, MAX_SONAR_DISTANCE
+
+# Global Definitions
+MIN_STAGGER = 33  # FirmataPlus won't ping faster than once every 33 ms
+MAX_STAGGER = 127  # The largest ping interval FirmataPlus accepts
+MAX_SONARS = 6  # The number of sonars FirmataPlus supports
+MIN_SECTOR_RATE = 5  # Updates per second below which a warning is logged
+
+# Sectors as name: (min angle, max angle) in degrees. 0 degrees is
+# straight ahead, positive angles are to the left of the robot
+DEFAULT_SECTORS = {
+    'left': (30, 180),
+    'front': (-30, 30),
+    'right': (-180, -30),
+}
+
+# A sonar mounted on the robot
+SonarMount = namedtuple('SonarMount', ['name', 'angle', 'trigger_pin', 'echo_pin'])
+
+# Nearest obstacle in a sector, the sonar that saw it and when
+SectorReading = namedtuple('SectorReading', ['distance', 'sonar', 'timestamp'])
+
+# Combined state of all sectors, sectors is a dictionary name: SectorReading
+SonarSnapshot = namedtuple('SonarSnapshot', ['timestamp', 'sectors'])
+
+log = logger.get('sonar_array')
+
+
+class SonarArray:
+    """ Control multiple HR-SR04 Sonar Distance Sensors
+
+    FirmataPlus pings the configured sonars one after another, one
+    sonar per ping interval. Configuring every sonar with the stagger
+    as its ping interval therefore gives a round robin schedule where
+    only one sonar is sending at any time, so echoes don't interfere.
+    Each sonar is updated once every len(mounts) * stagger ms.
+    """
+
+    def __init__(self, board, mounts, stagger=MIN_STAGGER, max_distance=MAX_SONAR_DISTANCE,
+                 sectors=DEFAULT_SECTORS, filter_type='moving_average', window_size=DEFAULT_WINDOW_SIZE):
+        """ Initialise the sonars
+
+        :param board: The interface into arduino
+        :param mounts: list of SonarMount, configured in this order
+        :param stagger: ms between two pings of consecutive sonars
+        :param max_distance: The maximum distance in cm that the sonars will read
+        :param sectors: dictionary name: (min angle, max angle)
+        :param filter_type: The filter used to smooth the readings of each sonar
+        :param window_size: The number of readings the filter works on
+        """
+        if not 0 < len(mounts) <= MAX_SONARS:
+            raise ValueError('Between 1 and {} sonars are supported'.format(MAX_SONARS))
+        if not MIN_STAGGER <= stagger <= MAX_STAGGER:
+            raise ValueError('stagger should be between {} and {} ms'.format(MIN_STAGGER, MAX_STAGGER))
+
+        self.stagger = stagger
+        self.mounts = list(mounts)
+        self.sonars = {}
+        self._sector_of = {}
+        for mount in self.mounts:
+            self.sonars[mount.name] = Sonar(board, mount.trigger_pin, mount.echo_pin,
+                                            ping_interval=stagger, max_distance=max_distance,
+                                            filter_type=filter_type, window_size=window_size)
+            self._sector_of[mount.name] = self._find_sector(mount.angle, sectors)
+
+        for sector, rate in self.sector_update_rates().items():
+            if rate < MIN_SECTOR_RATE:
+                log.warning('Sonar sector %s only updates %.1f times per second', sector, rate)
+
+        self.snapshot = SonarSnapshot(None, {sector: SectorReading(max_distance, None, None)
+                                             for sector in sectors})
+
+    def _find_sector(self, angle, sectors):
+        """ Returns the name of the sector an angle falls in """
+        for sector, (min_angle, max_angle) in sectors.items():
+            if min_angle <= angle <= max_angle:
+                return sector
+        raise ValueError('Sonar angle {} is not in any sector'.format(angle))
+
+    @property
+    def cycle_time(self):
+        """ Time in seconds for all sonars to ping once """
+        return len(self.mounts) * self.stagger / 1000
+
+    def sector_update_rates(self):
+        """ Returns the number of updates per second of each sector """
+        rates = {}
+        for name, sector in self._sector_of.items():
+            rates[sector] = rates.get(sector, 0) + 1 / self.cycle_time
+        return rates
+
+    async def start(self):
+        """ Configure the sonars on the board, in ping order """
+        for mount in self.mounts:
+            await self.sonars[mount.name].start()
+
+    async def run(self):
+        """ Sonar consumption task for all sonars """
+        for sonar in self.sonars.values():
+            sonar.add_listener(self._update_snapshot)
+        await asyncio.gather(*[sonar.run() for sonar in self.sonars.values()])
+
+    def _update_snapshot(self, sonar):
+        """ Rebuild the snapshot after a reading of one of the sonars
+
+        A new snapshot object is created so a reader always sees a
+        consistent state without any locking.
+        """
+        sectors = {}
+        for name, sector in self._sector_of.items():
+            candidate = self.sonars[name]
+            current = sectors.get(sector)
+            if current is None or candidate.distance < current.distance:
+                sectors[sector] = SectorReading(candidate.distance, name, candidate.updated)
+        for sector, reading in self.snapshot.sectors.items():
+            sectors.setdefault(sector, reading)
+        self.snapshot = SonarSnapshot(sonar.updated, sectors)
+
+    @property
+    def distance(self):
+        """ Returns the nearest distance in the front sector
+
+        This makes the array a drop-in replacement for a single Sonar.
+        Without a front sector the nearest distance of all sectors is
+        returned, None when there are no sectors at all.
+        """
+        sectors = self.snapshot.sectors
+        if 'front' in sectors:
+            return sectors['front'].distance
+        return min((reading.distance for reading in sectors.values()), default=None)
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+""" Stream the robot state to remote clients and take drive commands
+
+A UDP server that publishes batches of snapshots of the sonar
+distance, the motors and the controller, and accepts drive commands
+that are read like the controller by the manual driving.
+
+Datagrams from a client, all little endian:
+
+    b'S'                      subscribe to the snapshots
+    b'U'                      unsubscribe
+    b'A' + uint32             acknowledge the batch with that sequence number
+    b'D' + uint32 + 2 int16   drive: BUTTONS bitmask, left stick x and y -255..255
+
+Any datagram keeps a client alive for CLIENT_TIMEOUT seconds. A
+drive command lasts COMMAND_TIMEOUT seconds, clients resend it to
+keep driving.
+
+The server sends b'B' + uint32 batch sequence + uint8 count, followed
+by count SNAPSHOT records. A client that has WINDOW batches
+unacknowledged is only sent a batch every WINDOW publish cycles,
+with the newest MAX_BATCH snapshots merged into it and the ones
+before dropped. Sending never waits, so a slow client can't stall
+the control loop.
+"""
+
+import asyncio
+import socket
+import struct
+from collections import deque, namedtuple
+from ps3_controller import BUTTONS, AXES, BUTTON_SLOTS, AXIS_SLOTS
+from telemetry import STATES
+
+# Global Definitions
+STREAM_HOST = '127.0.0.1'  # Set to 0.0.0.0 to watch and drive from another machine
+STREAM_PORT = 9106
+SAMPLE_RATE = 20  # Snapshots per second
+PUBLISH_RATE = 10  # Batches per second
+MAX_BATCH = 20  # Snapshots per batch, a client that is behind skips the older ones
+WINDOW = 4  # Batches a client may leave unacknowledged
+MAX_CLIENTS = 8  # Datagrams from further addresses are ignored
+CLIENT_TIMEOUT = 5.0  # Seconds without a datagram before a client is forgotten
+COMMAND_TIMEOUT = 0.5  # Seconds a drive command lasts
+SEND_BUFFER_LIMIT = 64 * 1024  # Bytes the socket may have queued before batches are dropped
+
+# Datagram kinds and layouts
+SUBSCRIBE = b'S'
+UNSUBSCRIBE = b'U'
+ACKNOWLEDGE = b'A'
+DRIVE_COMMAND = b'D'
+SNAPSHOTS = b'B'
+ACK = struct.Struct('<cI')
+DRIVE = struct.Struct('<cIhh')
+BATCH = struct.Struct('<cIB')
+# time, sonar distance, motor state, autonomous state, wheel speeds in
+# WHEELS order, buttons, left stick x and y
+SNAPSHOT = struct.Struct('<dHBB4hIhh')
+
+STATE_NAMES = {code: name for name, code in STATES.items()}
+
+Snapshot = namedtuple('Snapshot', ['time', 'distance', 'motors', 'autonomous', 'speeds',
+                                   'buttons', 'left_axis_x', 'left_axis_y'])
+
+
+def button_mask(buttons):
+    """ Returns the bitmask of the pressed buttons
+
+    :param buttons: iterable of BUTTONS names
+    """
+    mask = 0
+    for button in buttons:
+        mask |= 1 << BUTTON_SLOTS[button]
+    return mask
+
+
+def decode_batch(data):
+    """ Decode a batch from the server
+
+    :param data: the datagram
+    :returns: (batch sequence number, list of Snapshots)
+    """
+    kind, sequence, count = BATCH.unpack_from(data)
+    snapshots = []
+    for offset in range(BATCH.size, BATCH.size + count * SNAPSHOT.size, SNAPSHOT.size):
+        time, distance, motors, autonomous, *values = SNAPSHOT.unpack_from(data, offset)
+        buttons = tuple(button for slot, button in enumerate(BUTTONS) if values[4] & 1 << slot)
+        snapshots.append(Snapshot(time, distance, STATE_NAMES.get(motors), STATE_NAMES.get(autonomous),
+                                  tuple(values[:4]), buttons, values[5], values[6]))
+    return sequence, snapshots
+
+
+class RemoteDrive:
+    """ The last drive command of the stream clients
+
+    Reads like a RemoteControl, connected while a command is fresh
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.buttons = [False] * len(BUTTONS)
+        self.axes = [0] * len(AXES)
+        self.expires = None
+
+    @property
+    def connected(self):
+        """ True while the last command is younger than COMMAND_TIMEOUT """
+        return self.expires is not None and self.loop.time() < self.expires
+
+    def update(self, buttons, x, y):
+        """ Take a drive command
+
+        :param buttons: bitmask of the pressed BUTTONS
+        :param x: Left stick x -255..255
+        :param y: Left stick y -255..255
+        """
+        self.buttons = [bool(buttons & 1 << slot) for slot in range(len(BUTTONS))]
+        self.axes[AXIS_SLOTS['LEFT_AXIS_X']] = max(-255, min(255, x))
+        self.axes[AXIS_SLOTS['LEFT_AXIS_Y']] = max(-255, min(255, y))
+        self.expires = self.loop.time() + COMMAND_TIMEOUT
+
+    def __getattr__(self, name):
+        """ Returns the state of a button or axis by name """
+        slot = BUTTON_SLOTS.get(name)
+        if slot is not None:
+            return self.buttons[slot]
+        slot = AXIS_SLOTS.get(name)
+        if slot is not None:
+            return self.axes[slot]
+        raise AttributeError(name)
+
+
+class Subscriber:
+    """ A client of the stream and how far it is behind """
+
+    def __init__(self, address, next_snapshot):
+        self.address = address
+        self.subscribed = False
+        self.last_seen = None
+        self.next_snapshot = next_snapshot  # Sequence number of the first snapshot not sent yet
+        self.batch = 0  # Sequence number of the last batch sent
+        self.acknowledged = 0
+        self.sent = 0
+        self.dropped = 0  # Snapshots this client never got
+        self.skipped = 0  # Publish cycles this client was too far behind for
+        self.stalled = 0  # Publish cycles skipped since the last batch
+
+
+class StreamServer(asyncio.DatagramProtocol):
+    """ Publishes robot snapshots to subscribed clients over UDP """
+
+    def __init__(self, robot, loop=None, host=STREAM_HOST, port=STREAM_PORT,
+                 sample_rate=SAMPLE_RATE, publish_rate=PUBLISH_RATE):
+        """ Initialise the server. Call start from the asyncio loop
+
+        :param robot: The Robot to publish
+        :param loop: The asyncio loop
+        :param host: Address to listen on, local only by default
+        :param port: UDP port to listen on
+        :param sample_rate: Snapshots per second
+        :param publish_rate: Batches per second, at most sample_rate
+        """
+        self.robot = robot
+        self.loop = loop or asyncio.get_event_loop()
+        self.host = host
+        self.port = port
+        self.sample_interval = 1 / sample_rate
+        self.publish_every = max(1, round(sample_rate / publish_rate))
+        self.drive = RemoteDrive(self.loop)
+        self.transport = None
+
+        # The latest encoded snapshots and the sequence number of the first one
+        self.snapshots = deque(maxlen=MAX_BATCH)
+        self.first_snapshot = 0
+        self.subscribers = {}  # address: Subscriber
+        self.dropped = 0  # Batches not sent because the socket buffer was full
+
+    async def start(self):
+        """ Open the UDP socket """
+        self.transport, protocol = await self.loop.create_datagram_endpoint(
+            lambda: self, local_addr=(self.host, self.port), family=socket.AF_INET)
+        self.port = self.transport.get_extra_info('sockname')[1]
+
+    def datagram_received(self, data, address):
+        subscriber = self.subscribers.get(address)
+        if subscriber is None:
+            if len(self.subscribers) >= MAX_CLIENTS:
+                return
+            subscriber = self.subscribers[address] = Subscriber(address, self._next_sequence())
+        subscriber.last_seen = self.loop.time()
+
+        kind = data[:1]
+        if kind == SUBSCRIBE:
+            subscriber.subscribed = True
+        elif kind == UNSUBSCRIBE:
+            subscriber.subscribed = False
+        elif kind == ACKNOWLEDGE and len(data) == ACK.size:
+            subscriber.acknowledged = max(subscriber.acknowledged, ACK.unpack(data)[1])
+        elif kind == DRIVE_COMMAND and len(data) == DRIVE.size:
+            kind, buttons, x, y = DRIVE.unpack(data)
+            self.drive.update(buttons, x, y)
+
+    def error_received(self, error):
+        # ICMP port unreachable from a client that went away, it times out
+        pass
+
+    def _next_sequence(self):
+        return self.first_snapshot + len(self.snapshots)
+
+    def sample(self):
+        """ Take a snapshot of the robot """
+        robot = self.robot
+        controller = robot.controller
+        mask = 0
+        for slot, pressed in enumerate(controller.buttons):
+            if pressed:
+                mask |= 1 << slot
+        if len(self.snapshots) == self.snapshots.maxlen:
+            self.first_snapshot += 1
+        self.snapshots.append(SNAPSHOT.pack(
+            self.loop.time(), min(int(robot.sonar.distance), 0xffff),
+            STATES[robot.dc_motors.state], STATES[robot.autonomous.state],
+            *robot.dc_motors.speeds, mask, controller.LEFT_AXIS_X, controller.LEFT_AXIS_Y))
+
+    def publish(self):
+        """ Send every subscriber the snapshots it did not get yet """
+        now = self.loop.time()
+        end = self._next_sequence()
+        for address, subscriber in list(self.subscribers.items()):
+            if now - subscriber.last_seen > CLIENT_TIMEOUT:
+                del self.subscribers[address]
+                continue
+            if not subscriber.subscribed or subscriber.next_snapshot >= end:
+                continue
+            if subscriber.batch - subscriber.acknowledged >= WINDOW and subscriber.stalled < WINDOW:
+                # Behind, or its acknowledgements got lost. Try again after WINDOW cycles
+                subscriber.skipped += 1
+                subscriber.stalled += 1
+                continue
+            if self.transport.get_write_buffer_size() > SEND_BUFFER_LIMIT:
+                self.dropped += 1
+                continue
+
+            start = max(subscriber.next_snapshot, self.first_snapshot)
+            subscriber.dropped += start - subscriber.next_snapshot
+            subscriber.batch += 1
+            batch = list(self.snapshots)[start - self.first_snapshot:]
+            self.transport.sendto(BATCH.pack(SNAPSHOTS, subscriber.batch, len(batch)) + b''.join(batch), address)
+            subscriber.sent += len(batch)
+            subscriber.next_snapshot = end
+            subscriber.stalled = 0
+
+    async def run(self):
+        """ Sampling task, publishes every publish_every snapshots """
+        deadline = self.loop.time()
+        samples = 0
+        while True:
+            self.sample()
+            samples += 1
+            if samples % self.publish_every == 0:
+                self.publish()
+            deadline += self.sample_interval
+            await asyncio.sleep(max(0, deadline - self.loop.time()))
+
+    def close(self):
+        """ Close the socket """
+        if self.transport:
+            self.transport.close()
+
+    def __str__(self):
+        return '%d clients, %d snapshots sent, %d dropped, %d batches dropped on a full socket buffer' % (
+            len(self.subscribers), sum(subscriber.sent for subscriber in self.subscribers.values()),
+            sum(subscriber.dropped for subscriber in self.subscribers.values()), self.dropped)
+
+
+class StreamClient(asyncio.DatagramProtocol):
+    """ Receives the stream and sends drive commands, for a laptop or tests """
+
+    def __init__(self, loop=None, acknowledge=True):
+        """ Initialise the client. Call connect from the asyncio loop
+
+        :param loop: The asyncio loop
+        :param acknowledge: Acknowledge every batch, turn off to act like a stalled client
+        """
+        self.loop = loop or asyncio.get_event_loop()
+        self.acknowledge = acknowledge
+        self.transport = None
+        self.snapshots = asyncio.Queue()
+        self.batches = 0
+
+    async def connect(self, host=STREAM_HOST, port=STREAM_PORT, subscribe=True):
+        """ Connect to a StreamServer
+
+        :param subscribe: Subscribe to the snapshots
+        """
+        self.transport, protocol = await self.loop.create_datagram_endpoint(
+            lambda: self, remote_addr=(host, port), family=socket.AF_INET)
+        if subscribe:
+            self.transport.sendto(SUBSCRIBE)
+
+    def datagram_received(self, data, address):
+        sequence, snapshots = decode_batch(data)
+        self.batches += 1
+        if self.acknowledge:
+            self.transport.sendto(ACK.pack(ACKNOWLEDGE, sequence))
+        for snapshot in snapshots:
+            self.snapshots.put_nowait(snapshot)
+
+    def error_received(self, error):
+        pass
+
+    def drive(self, buttons=(), x=0, y=0):
+        """ Send a drive command
+
+        :param buttons: The pressed BUTTONS names, like ('UP', 'LEFT')
+        :param x: Left stick x -255..255
+        :param y: Left stick y -255..255
+        """
+        self.transport.sendto(DRIVE.pack(DRIVE_COMMAND, button_mask(buttons), x, y))
+
+    def close(self):
+        if self.transport:
+            self.transport.sendto(UNSUBSCRIBE)
+            self.transport.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Watch the robot stream')
+    parser.add_argument('--host', default=STREAM_HOST)
+    parser.add_argument('--port', type=int, default=STREAM_PORT)
+    args = parser.parse_args()
+
+    async def watch(client):
+        await client.connect(args.host, args.port)
+        while True:
+            snapshot = await client.snapshots.get()
+            print('{:9.2f} {:>3} cm  motors {:<13} autonomous {:<9} speeds {}  {}'.format(
+                snapshot.time, snapshot.distance, snapshot.motors, snapshot.autonomous,
+                snapshot.speeds, ' '.join(snapshot.buttons)))
+
+    loop = asyncio.get_event_loop()
+    client = StreamClient(loop)
+    try:
+        loop.run_until_complete(watch(client))
+    except KeyboardInterrupt:
+        client.close()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+""" Binary telemetry recorder
+
+Records are 32 bytes and written into a preallocated, memory mapped
+ring file. Writing one is a single struct.pack_into, and because the
+mapping is shared with the file the records end up on disk even when
+the process crashes.
+
+File layout: a HEADER_SIZE byte header followed by capacity records.
+"""
+
+import mmap
+import struct
+import time
+
+# Global Definitions
+MAGIC = b'MTLM'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIQ')  # magic, version, record size, capacity, records written
+HEADER_SIZE = 64
+RECORD = struct.Struct('<dIHHiiii')  # time, sequence, kind, code, value0-3
+DEFAULT_CAPACITY = 1 << 20  # 32 MB worth of records
+
+# Record kinds and what their code and values contain
+SONAR = 1  # code: trigger pin, value0: distance in cm
+CONTROLLER = 2  # code: evdev code, value0: evdev type, value1: evdev value
+MOTOR = 3  # code: pin, value0: value written, value1: 0 digital, 1 PWM
+STATE = 4  # code: one of the STATE_* subsystems, value0: state from STATES or the seed
+
+KINDS = {SONAR: 'sonar', CONTROLLER: 'controller', MOTOR: 'motor', STATE: 'state'}
+
+# Subsystems of STATE records
+STATE_MOTORS = 0
+STATE_DRIVING_MODE = 1
+STATE_SEED = 2  # The seed of the random decisions of the run
+STATE_AUTONOMOUS = 3  # The state of autonomous.AutonomousDriving
+
+STATES = {
+    'stopped': 0,
+    'forward': 1,
+    'reverse': 2,
+    'turning_left': 3,
+    'turning_right': 4,
+    'manual': 10,
+    'autonomous': 11,
+    'idle': 20,
+    'cruise': 21,
+    'turning': 22,
+    'cleared': 23,
+    'reversing': 24,
+}
+
+MOTOR_DIGITAL = 0
+MOTOR_PWM = 1
+
+
+class TelemetryRecorder:
+    """ Write telemetry records into a memory mapped ring file
+
+    When the ring is full the oldest records are overwritten.
+    """
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY, clock=None):
+        """ Create or truncate the ring file and map it
+
+        :param path: The file to record to
+        :param capacity: The number of records the ring holds
+        :param clock: function returning the timestamp of a record,
+                      Robot sets this to the loop time
+        """
+        self.path = path
+        self.capacity = capacity
+        self.clock = clock or time.monotonic
+        self.sequence = 0
+
+        size = HEADER_SIZE + capacity * RECORD.size
+        self._file = open(path, 'w+b')
+        self._file.truncate(size)
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+        HEADER.pack_into(self._mmap, 0, MAGIC, VERSION, RECORD.size, capacity, 0)
+
+    def record(self, kind, code, value0=0, value1=0, value2=0, value3=0):
+        """ Append a record to the ring
+
+        :param kind: One of SONAR, CONTROLLER, MOTOR or STATE
+        :param code: The code of the record, see the kinds
+        :param value0: First value, see the kinds
+        """
+        offset = HEADER_SIZE + (self.sequence % self.capacity) * RECORD.size
+        RECORD.pack_into(self._mmap, offset, self.clock(), self.sequence,
+                         kind, code, value0, value1, value2, value3)
+        self.sequence += 1
+        # Records written is the last header field
+        struct.pack_into('<Q', self._mmap, HEADER.size - 8, self.sequence)
+
+    def record_state(self, subsystem, state):
+        """ Record a state transition
+
+        :param subsystem: STATE_MOTORS, STATE_DRIVING_MODE or STATE_AUTONOMOUS
+        :param state: a key of STATES
+        """
+        self.record(STATE, subsystem, STATES[state])
+
+    def flush(self):
+        """ Ask the kernel to write the mapped records to disk """
+        self._mmap.flush()
+
+    def close(self):
+        """ Flush and unmap the ring file """
+        self._mmap.flush()
+        self._mmap.close()
+        self._file.close()
+
+
+def record_dtype():
+    """ Returns the NumPy dtype of a telemetry record """
+    import numpy
+    return numpy.dtype([('time', '<f8'), ('sequence', '<u4'), ('kind', '<u2'), ('code', '<u2'),
+                        ('value0', '<i4'), ('value1', '<i4'), ('value2', '<i4'), ('value3', '<i4')])
+
+
+def read_header(path):
+    """ Returns (capacity, records written) of a telemetry file """
+    with open(path, 'rb') as telemetry:
+        magic, version, record_size, capacity, written = HEADER.unpack(telemetry.read(HEADER.size))
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        raise ValueError('{} is not a version {} telemetry file'.format(path, VERSION))
+    return capacity, written
+
+
+def read_telemetry(path, chunk_size=65536):
+    """ Stream the records of a telemetry file, oldest first
+
+    :param path: The telemetry file
+    :param chunk_size: The number of records per chunk
+    :returns: generator of NumPy structured arrays with record_dtype()
+    """
+    import numpy
+
+    capacity, written = read_header(path)
+    records = numpy.memmap(path, dtype=record_dtype(), mode='r',
+                           offset=HEADER_SIZE, shape=(capacity,))
+    first = max(0, written - capacity)
+    for start in range(first, written, chunk_size):
+        stop = min(start + chunk_size, written)
+        begin, end = start % capacity, stop % capacity
+        if end == 0:
+            end = capacity
+        if begin < end:
+            yield numpy.array(records[begin:end])
+        else:
+            yield numpy.concatenate((records[begin:], records[:end]))
+
+
+def load_telemetry(path):
+    """ Returns all records of a telemetry file as one structured array """
+    import numpy
+    chunks = list(read_telemetry(path))
+    if not chunks:
+        return numpy.zeros(0, dtype=record_dtype())
+    return numpy.concatenate(chunks)
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) != 2:
+        print('Usage: {} <telemetry file>'.format(sys.argv[0]))
+        sys.exit(1)
+
+    records = load_telemetry(sys.argv[1])
+    print('{} records, {:.1f} seconds'.format(len(records),
+                                              records['time'][-1] - records['time'][0] if len(records) else 0))
+    for kind, name in sorted(KINDS.items()):
+        print('{:<12} {}'.format(name, int((records['kind'] == kind).sum())))
@@ -0,0 +1,46 @@
+import contextlib
+import io
+from replay import Recording, replay, compare_commands, write_golden, read_golden
+from simulation import simulate, World, press, release, stick
+from telemetry import TelemetryRecorder
+
+# Autonomous driving around an obstacle, then a stretch of manual driving.
+# The events fall between control cycles: an event at the same time as
+# a cycle may be read before or after it, see replay.TIME_TOLERANCE
+SCRIPT = [press(0.505, 'SELECT'), release(0.605, 'SELECT'),
+          press(20.005, 'SELECT'), release(20.105, 'SELECT'),
+          stick(21.005, 'LEFT_AXIS_Y', 0), stick(23.005, 'LEFT_AXIS_X', 255), stick(25.005, 'LEFT_AXIS_Y', 128)]
+
+
+def record_run(path):
+    """ Record a short simulated run and return it as a Recording """
+    world = World.room(400, 300, obstacles=[(200, 100, 40, 40)])
+    recorder = TelemetryRecorder(str(path), capacity=1 << 16)
+    with contextlib.redirect_stdout(io.StringIO()):
+        simulate(SCRIPT, duration=30, world=world, seed=7, telemetry=recorder)
+    recorder.close()
+    return Recording.load(str(path))
+
+
+def replay_quietly(recording):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return replay(recording)
+
+
+def test_replay_matches_recording(tmp_path):
+    recording = record_run(tmp_path / 'run.bin')
+    assert recording.motor_commands
+    assert replay_quietly(recording) == recording.motor_commands
+
+
+def test_replay_is_deterministic(tmp_path):
+    recording = record_run(tmp_path / 'run.bin')
+    assert replay_quietly(recording) == replay_quietly(recording)
+
+
+def test_golden_round_trip(tmp_path):
+    recording = record_run(tmp_path / 'run.bin')
+    commands = replay_quietly(recording)
+    golden = tmp_path / 'run.golden'
+    write_golden(str(golden), commands)
+    compare_commands(read_golden(str(golden)), replay_quietly(recording), tolerance=1e-6)
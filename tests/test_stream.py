@@ -0,0 +1,137 @@
+import asyncio
+import contextlib
+import io
+import pytest
+import stream
+from robot import Robot
+from ps3_controller import RemoteControl
+from simulation import SimulatedBoard, SimulatedAudio, ScriptedInputDevice, InlineExecutor, World
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def robot(loop):
+    """ A simulated Robot that isn't running, with its stream on a free port """
+    board = SimulatedBoard(loop, World.room(400, 300), (50.0, 50.0, 0.0))
+    controller = RemoteControl(loop=loop, device=ScriptedInputDevice([], loop))
+    with contextlib.redirect_stdout(io.StringIO()):
+        robot = Robot(False, loop, board=board, controller=controller, audio=SimulatedAudio(loop),
+                      plan_executor=InlineExecutor(), stream_port=0)
+    loop.run_until_complete(robot.stream.start())
+    yield robot
+    robot.stream.close()
+
+
+def connect(loop, server, acknowledge=True):
+    client = stream.StreamClient(loop, acknowledge)
+    loop.run_until_complete(client.connect('127.0.0.1', server.port))
+    settle(loop)
+    return client
+
+
+def settle(loop):
+    """ Let the datagrams in flight on the loopback arrive """
+    loop.run_until_complete(asyncio.sleep(0.05))
+
+
+def received(client):
+    snapshots = []
+    while not client.snapshots.empty():
+        snapshots.append(client.snapshots.get_nowait())
+    return snapshots
+
+
+def test_subscriber_gets_snapshots(loop, robot):
+    server = robot.stream
+    client = connect(loop, server)
+    assert [subscriber.subscribed for subscriber in server.subscribers.values()] == [True]
+
+    server.sample()
+    server.publish()
+    settle(loop)
+    snapshots = received(client)
+    assert len(snapshots) == 1
+    assert snapshots[0].motors == robot.dc_motors.state
+    assert snapshots[0].time <= loop.time()
+
+    client.close()
+
+
+def test_snapshot_time_keeps_its_precision():
+    # The loop clock counts from boot, a float32 already has a step of 1 ms after a few hours
+    data = stream.BATCH.pack(stream.SNAPSHOTS, 1, 1) + stream.SNAPSHOT.pack(
+        12345.6789, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    sequence, snapshots = stream.decode_batch(data)
+    assert snapshots[0].time == 12345.6789
+
+
+def test_batches_hold_the_newest_max_batch_snapshots(loop, robot):
+    server = robot.stream
+    client = connect(loop, server)
+
+    for _ in range(stream.MAX_BATCH + 5):
+        server.sample()
+    server.publish()
+    settle(loop)
+    assert len(received(client)) == stream.MAX_BATCH
+    subscriber, = server.subscribers.values()
+    assert subscriber.dropped == 5
+
+    client.close()
+
+
+def test_unacknowledged_batches_stall_the_client(loop, robot):
+    server = robot.stream
+    client = connect(loop, server, acknowledge=False)
+
+    for _ in range(stream.WINDOW * 3):
+        server.sample()
+        server.publish()
+        settle(loop)
+    subscriber, = server.subscribers.values()
+    # WINDOW batches, then one more every WINDOW publish cycles
+    assert client.batches == stream.WINDOW + 1
+    assert subscriber.skipped == stream.WINDOW * 2 - 1
+
+    client.close()
+
+
+def test_acknowledged_batches_are_sent_every_cycle(loop, robot):
+    server = robot.stream
+    client = connect(loop, server)
+
+    for _ in range(stream.WINDOW * 3):
+        server.sample()
+        server.publish()
+        settle(loop)
+    subscriber, = server.subscribers.values()
+    assert client.batches == stream.WINDOW * 3
+    assert subscriber.skipped == 0
+
+    client.close()
+
+
+def test_drive_commands_reach_manual_control(loop, robot):
+    server = robot.stream
+    client = connect(loop, server, acknowledge=False)
+
+    client.drive(('UP',))
+    settle(loop)
+    assert server.drive.connected
+    robot._control_tick()
+    assert robot.dc_motors.state == 'forward'
+
+    # The motors stop when the commands run out
+    server.drive.expires = loop.time()
+    robot._control_tick()
+    assert robot.dc_motors.state == 'stopped'
+
+    client.close()